@@ -0,0 +1,194 @@
+import sys
+import json
+import heapq
+import random
+import argparse
+import platform
+import tracemalloc
+
+import kbtt
+
+
+ENGINES = {
+    'dict': kbtt.TimeTracker,
+    'table': kbtt.TableTimeTracker,
+    'compact': kbtt.CompactTimeTracker,
+    'columnar': kbtt.ColumnarTimeTracker,
+}
+
+
+def generate_events(events=1000, devices=2, users=2, ttl=30, pause_rate=0.01,
+                    jitter=0.4, disconnect_rate=0.02, disorder=0.0,
+                    end=True, seed=0):
+    # devices belong to users round-robin and send connect heartbeats every
+    # ttl * uniform(0, 2 * jitter), so with jitter above 0.5 some of them
+    # expire, disorder is the share of events delivered a few places late
+    rng = random.Random(seed)
+    result = [{'t': kbtt.EventType.START, 'c': 0}]
+    queue = [(rng.uniform(0, ttl * jitter), device)
+             for device in range(devices)]
+    heapq.heapify(queue)
+
+    paused, connected = False, set()
+    while len(result) < events - end:
+        current_time, device = queue[0]
+        if rng.random() < pause_rate:
+            paused = not paused
+            result.append({
+                't': kbtt.EventType.PAUSE if paused else
+                     kbtt.EventType.UNPAUSE,
+                'c': round(current_time, 3),
+            })
+            continue
+
+        disconnect = device in connected and rng.random() < disconnect_rate
+        connected.add(device)
+        result.append({
+            't': kbtt.EventType.DISCONNECT if disconnect else
+                 kbtt.EventType.CONNECT,
+            'c': round(current_time, 3),
+            'u': device % users + 1,
+            'd': str(device + 1),
+        })
+        delay = ttl * rng.uniform(0, 2 * jitter)
+        if disconnect:
+            delay += ttl * rng.expovariate(1)
+        heapq.heapreplace(queue, (current_time + delay, device))
+
+    current_time = result[-1]['c'] if len(result) > 1 else 0
+    if end:
+        current_time += ttl
+        result.append({'t': kbtt.EventType.END, 'c': current_time})
+
+    # late disconnects could precede the first device connect, which the
+    # reducer doesn't accept, so only other events are delivered late
+    for index in range(1, len(result)):
+        if (rng.random() < disorder and
+                result[index]['t'] != kbtt.EventType.DISCONNECT):
+            other = max(0, index - rng.randint(1, 8))
+            result[index], result[other] = result[other], result[index]
+
+    return {'events': result, 'ttl': ttl, 'currentTime': current_time + ttl}
+
+
+def percentiles(values):
+    values = sorted(values)
+
+    def pick(q):
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        'min': values[0],
+        'p50': pick(0.5),
+        'p90': pick(0.9),
+        'p99': pick(0.99),
+        'max': values[-1],
+    }
+
+
+def measure_stages(tracker, value):
+    profile = kbtt.Profile()
+    tracker.hooks = [profile]
+    tracker.track(value)
+    tracker.hooks = []
+
+    timings = {}
+    for stats in profile.stages:
+        timings[stats['stage']] = (timings.get(stats['stage'], 0) +
+                                   stats['time'])
+    timings['total'] = sum(timings.values())
+    return timings
+
+
+def run_benchmark(engine, value, repeat=5):
+    tracker = ENGINES[engine]()
+    runs = [measure_stages(tracker, value) for i in range(repeat)]
+
+    tracemalloc.start()
+    tracker.track(value)
+    peak_memory = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+
+    stages = {stage: percentiles([run[stage] for run in runs])
+              for stage in runs[0]}
+    return {
+        'engine': engine,
+        'events': len(value['events']),
+        'throughput': len(value['events']) / stages['total']['p50'],
+        'peakMemory': peak_memory,
+        'stages': stages,
+    }
+
+
+def compare(results, baseline):
+    # p50 ratios of current to baseline runs with the same engine and size
+    baseline = {(i['engine'], i['events']): i for i in baseline['results']}
+    for result in results['results']:
+        other = baseline.get((result['engine'], result['events']))
+        if other is None:
+            continue
+        for stage, timing in result['stages'].items():
+            if stage in other['stages']:
+                sys.stdout.write('%s %s %s: %.2fx\n' % (
+                    result['engine'], result['events'], stage,
+                    timing['p50'] / other['stages'][stage]['p50']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='KB time tracker benchmark.')
+    parser.add_argument('--events', type=int, nargs='+', default=[100000],
+                        help='event counts to benchmark')
+    parser.add_argument('--devices', type=int, default=4)
+    parser.add_argument('--users', type=int, default=2)
+    parser.add_argument('--ttl', type=float, default=30)
+    parser.add_argument('--pause-rate', type=float, default=0.01)
+    parser.add_argument('--jitter', type=float, default=0.4,
+                        help='heartbeat delay relative to ttl')
+    parser.add_argument('--disconnect-rate', type=float, default=0.02)
+    parser.add_argument('--disorder', type=float, default=0.0,
+                        help='share of out-of-order events')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--engine', nargs='+', default=['dict'],
+                        choices=sorted(ENGINES))
+    parser.add_argument('--output', help='write results JSON to the file')
+    parser.add_argument('--compare', help='results JSON file to compare with')
+    args = parser.parse_args(argv)
+
+    params = {
+        'devices': args.devices,
+        'users': args.users,
+        'ttl': args.ttl,
+        'pause_rate': args.pause_rate,
+        'jitter': args.jitter,
+        'disconnect_rate': args.disconnect_rate,
+        'disorder': args.disorder,
+        'seed': args.seed,
+    }
+    results = {
+        'python': platform.python_version(),
+        'params': params,
+        'results': [],
+    }
+    for events in args.events:
+        value = generate_events(events, **params)
+        for engine in args.engine:
+            result = run_benchmark(engine, value, args.repeat)
+            results['results'].append(result)
+            sys.stdout.write('%s %s events: %.0f events/s, p50 %.4fs, '
+                             'peak memory %s bytes\n' % (
+                                 engine, result['events'],
+                                 result['throughput'],
+                                 result['stages']['total']['p50'],
+                                 result['peakMemory']))
+
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(results, output, indent=2)
+    if args.compare:
+        with open(args.compare) as baseline:
+            compare(results, json.load(baseline))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,333 @@
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import concurrent.futures
+
+import kbtt
+
+
+def track_engine(tracker_class, **options):
+    def track(value):
+        tracker = tracker_class()
+        for name, option in options.items():
+            setattr(tracker, name, option)
+        return tracker.track(json.dumps(value))
+    return track
+
+
+def polled_time(value):
+    # time of the latest event polling engines read, they stop at the end
+    return next((event['c'] for event in
+                 sorted(value['events'], key=kbtt.get_time)
+                 if event['t'] == kbtt.EventType.END),
+                max([event['c'] for event in value['events']], default=None))
+
+
+def session_error(value):
+    # the error expected instead of the reference result, if any
+    time = polled_time(value)
+    if time is not None and (value['currentTime'] is None or
+                             value['currentTime'] < time):
+        return {'error': 'Current time precedes appended events.'}
+    return None
+
+
+def ndjson_error(value):
+    if value['currentTime'] is None:
+        return {'error': 'Invalid currentTime value. Number is required.'}
+    time = polled_time(value)
+    if time is not None and value['currentTime'] < time:
+        return {'error': 'Current time precedes events.'}
+    return None
+
+
+def track_session(value, chunk_size=3):
+    # appended in time order, polled with currentTime as is
+    events = sorted(value['events'], key=kbtt.get_time)
+    session = kbtt.TrackingSession(value['ttl'])
+    for index in range(0, len(events), chunk_size):
+        session.extend(events[index:index + chunk_size])
+    try:
+        return session.result(value['currentTime'])
+    except ValueError as error:
+        return {'error': str(error)}
+
+
+track_session.expected_error = session_error
+
+
+def track_ndjson(value):
+    events = sorted(value['events'], key=kbtt.get_time)
+    lines = [json.dumps({'ttl': value['ttl'],
+                         'currentTime': value['currentTime']})]
+    lines.extend(map(json.dumps, events))
+    return kbtt.TimeTracker().track_ndjson(lines, chunk_size=4)
+
+
+track_ndjson.expected_error = ndjson_error
+
+
+def track_log(value):
+    tracker = kbtt.TimeTracker()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'events.kbtl')
+        tracker.convert_log(value, path)
+        with kbtt.EventLog(path) as log:
+            return tracker.track_log(log)
+
+
+def track_compacted(value):
+    tracker = kbtt.TimeTracker()
+    return tracker.track(tracker.compact(json.dumps(value)))
+
+
+def track_sweep(value):
+    result = kbtt.TimeTracker().sweep_ttl(json.dumps(value), [value['ttl']])
+    result = result[0]
+    del result['ttl']
+    return result
+
+
+def get_engines(executor=None):
+    # engine name to value -> track result callables, the dict engine is
+    # the current TimeTracker the others are compared with
+    engines = {
+        'dict': track_engine(kbtt.TimeTracker),
+        'table': track_engine(kbtt.TableTimeTracker),
+        'compact': track_engine(kbtt.CompactTimeTracker),
+        'session': track_session,
+        'ndjson': track_ndjson,
+        'log': track_log,
+        'compacted': track_compacted,
+        'sweep': track_sweep,
+    }
+    try:
+        kbtt.import_numpy()
+        engines['columnar'] = track_engine(kbtt.ColumnarTimeTracker)
+    except ImportError:
+        pass
+    if executor is not None:
+        engines['parallel'] = track_engine(
+            kbtt.TimeTracker, executor=executor, parallel_devices=1,
+            parallel_events=0, group_events=4)
+    return engines
+
+
+def generate_value(rng, events=40):
+    # small logs dense in edge cases: time ties, gaps of exactly ttl and
+    # ttl / 2, repeated pauses and disconnects, end events mid-stream,
+    # users switching devices, float times and disorder
+    ttl = rng.choice([1, 2, 3, 4, 10, 0.5, 2.5])
+    devices = rng.randint(1, 5)
+    users = {str(i): rng.randint(1, 3) for i in range(devices)}
+    floats = rng.random() < 0.3
+
+    result, current_time = [], 0
+    for i in range(rng.randint(0, events)):
+        current_time += rng.choice([0, 0, 1, 1, 2, ttl / 2, ttl, ttl * 2])
+        c = current_time + (0.25 if floats and rng.random() < 0.5 else 0)
+        kind = rng.random()
+        if kind < 0.03:
+            result.append({'t': kbtt.EventType.END, 'c': c})
+        elif kind < 0.08:
+            result.append({'t': kbtt.EventType.START, 'c': c})
+        elif kind < 0.2:
+            result.append({'t': rng.choice([kbtt.EventType.PAUSE,
+                                            kbtt.EventType.UNPAUSE]),
+                           'c': c})
+        else:
+            device = rng.choice(list(users))
+            if rng.random() < 0.05:
+                users[device] = rng.randint(1, 3)
+            result.append({
+                't': rng.choice([kbtt.EventType.CONNECT] * 3 +
+                                [kbtt.EventType.DISCONNECT]),
+                'c': c,
+                'u': users[device],
+                'd': device,
+            })
+
+    if rng.random() < 0.2:
+        rng.shuffle(result)
+    elif rng.random() < 0.3:
+        for i in range(min(3, len(result))):
+            a, b = rng.randrange(len(result)), rng.randrange(len(result))
+            result[a], result[b] = result[b], result[a]
+
+    return {
+        'events': result,
+        'ttl': ttl,
+        'currentTime': rng.choice([None, current_time - 1, current_time,
+                                   current_time + ttl / 2,
+                                   current_time + ttl, current_time + 100]),
+    }
+
+
+EDGE_CASES = [
+    {'events': [], 'ttl': 1, 'currentTime': None},
+    # ttl-expiry disconnect at last_connected + ttl / 2
+    {'events': [
+        {'t': 'c', 'c': 0, 'u': 1, 'd': '1'},
+        {'t': 'c', 'c': 0, 'u': 2, 'd': '2'},
+        {'t': 'c', 'c': 4, 'u': 1, 'd': '1'},
+    ], 'ttl': 4, 'currentTime': 8},
+    # double pauses and unpauses
+    {'events': [
+        {'t': 'c', 'c': 0, 'u': 1, 'd': '1'},
+        {'t': 'c', 'c': 0, 'u': 2, 'd': '2'},
+        {'t': 'p', 'c': 1}, {'t': 'p', 'c': 2},
+        {'t': 'u', 'c': 3}, {'t': 'u', 'c': 4},
+    ], 'ttl': 10, 'currentTime': 5},
+    # end events mid-stream
+    {'events': [
+        {'t': 'c', 'c': 0, 'u': 1, 'd': '1'},
+        {'t': 'c', 'c': 1, 'u': 2, 'd': '2'},
+        {'t': 'e', 'c': 2},
+        {'t': 'd', 'c': 2, 'u': 2, 'd': '2'},
+        {'t': 'e', 'c': 3},
+        {'t': 'c', 'c': 4, 'u': 3, 'd': '3'},
+    ], 'ttl': 10, 'currentTime': 5},
+]
+
+
+def outcome(engine, value):
+    # the result or the exception type as a type-strict JSON string, engines
+    # should raise alike and keep int times as ints
+    try:
+        result = engine(value)
+    except Exception as error:
+        result = type(error).__name__
+    return json.dumps(result, sort_keys=True)
+
+
+def expected_outcomes(engine, value, expected):
+    # engines rejecting values outside their contract, like polling ones
+    # with a null or early currentTime, should return their error instead,
+    # values the reference raises on (a JSON string) may fail either way
+    error = getattr(engine, 'expected_error', None)
+    error = error and error(value)
+    if error is None:
+        return [expected]
+    error = json.dumps(error, sort_keys=True)
+    if expected.startswith('"'):
+        return [expected, error]
+    return [error]
+
+
+def shrink(value, fails):
+    # drops event runs of halving length, then simplifies currentTime and
+    # event times while the value still fails
+    events = value['events']
+    size = max(1, len(events) // 2)
+    while True:
+        index, changed = 0, False
+        while index < len(events):
+            candidate = events[:index] + events[index + size:]
+            if fails(dict(value, events=candidate)):
+                events, changed = candidate, True
+            else:
+                index += size
+        if size == 1 and not changed:
+            break
+        size = max(1, size // 2)
+    value = dict(value, events=events)
+
+    for current_time in (None, 0):
+        if value['currentTime'] != current_time and fails(
+                dict(value, currentTime=current_time)):
+            value = dict(value, currentTime=current_time)
+    for index, event in enumerate(value['events']):
+        for c in (0, int(event['c'])):
+            events = list(value['events'])
+            events[index] = dict(event, c=c)
+            if c != event['c'] and fails(dict(value, events=events)):
+                value = dict(value, events=events)
+                break
+    return value
+
+
+def run(cases=1000, seed=0, events=40, engines=None, reference='dict'):
+    # compares engines with the reference on edge cases and random values,
+    # returns per engine stats with the first failure shrunk
+    engines = dict(engines or get_engines())
+    reference = engines.pop(reference)
+    rng = random.Random(seed)
+    values = EDGE_CASES + [generate_value(rng, events)
+                           for i in range(cases)]
+
+    stats = {name: {'cases': 0, 'rejected': 0, 'failures': 0, 'time': 0.0,
+                    'referenceTime': 0.0, 'failure': None}
+             for name in engines}
+    for value in values:
+        started = time.perf_counter()
+        expected = outcome(reference, value)
+        reference_time = time.perf_counter() - started
+        for name, engine in engines.items():
+            started = time.perf_counter()
+            result = outcome(engine, value)
+            stats[name]['time'] += time.perf_counter() - started
+            stats[name]['referenceTime'] += reference_time
+            stats[name]['cases'] += 1
+            outcomes = expected_outcomes(engine, value, expected)
+            if outcomes != [expected]:
+                stats[name]['rejected'] += 1
+            if result in outcomes:
+                continue
+            stats[name]['failures'] += 1
+            if stats[name]['failure'] is None:
+                stats[name]['failure'] = shrink(
+                    value, lambda value: is_failing(engine, reference, value))
+
+    for engine_stats in stats.values():
+        # time relative to the reference over the same compared values
+        engine_stats['relativeTime'] = (
+            engine_stats['time'] / engine_stats['referenceTime']
+            if engine_stats['referenceTime'] else None)
+    return stats
+
+
+def is_failing(engine, reference, value):
+    return outcome(engine, value) not in expected_outcomes(
+        engine, value, outcome(reference, value))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description='KB time tracker engines differential fuzzer.')
+    parser.add_argument('--cases', type=int, default=1000)
+    parser.add_argument('--events', type=int, default=40,
+                        help='maximum events per generated value')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--engine', nargs='+',
+                        help='engines to compare with dict, all by default')
+    parser.add_argument('--output', help='write stats JSON to the file')
+    args = parser.parse_args(argv)
+
+    with concurrent.futures.ThreadPoolExecutor(2) as executor:
+        engines = get_engines(executor)
+        if args.engine:
+            engines = {name: engines[name]
+                       for name in ['dict'] + args.engine}
+        stats = run(args.cases, args.seed, args.events, engines)
+
+    for name, engine_stats in stats.items():
+        sys.stdout.write('%s: %s cases, %s rejected, %s failures, '
+                         '%.2fx time\n' % (
+                             name, engine_stats['cases'],
+                             engine_stats['rejected'],
+                             engine_stats['failures'],
+                             engine_stats['relativeTime'] or 0))
+        if engine_stats['failure'] is not None:
+            sys.stdout.write('  %s\n' % json.dumps(engine_stats['failure']))
+    if args.output:
+        with open(args.output, 'w') as output:
+            json.dump(stats, output, indent=2)
+    return 1 if any(i['failures'] for i in stats.values()) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,45 @@
+import sys
+import socket
+
+
+# thin client for the kbtt.py --serve tracker server, keeps the kbtt.py
+# stdin/stdout contract and imports nothing else to start up fast:
+# $ cat input.json | python3 kbtt_client.py unix:/tmp/kbtt.sock
+
+
+def parse_address(address):
+    # "unix:/path/to/socket" or "host:port", returns (path, None) or
+    # (host, port)
+    if address.startswith('unix:'):
+        return address[5:], None
+    host, _, port = address.rpartition(':')
+    return host or 'localhost', int(port)
+
+
+def request(address, value):
+    # sends JSON text or bytes and returns result bytes, raw newlines in
+    # JSON text are whitespace only, so they are replaced
+    if isinstance(value, str):
+        value = value.encode()
+    path, port = parse_address(address)
+    if port is None:
+        connection = socket.socket(socket.AF_UNIX)
+        connection.connect(path)
+    else:
+        connection = socket.create_connection((path, port))
+    with connection, connection.makefile('rb') as stream:
+        connection.sendall(
+            value.replace(b'\n', b' ').replace(b'\r', b' ') + b'\n')
+        return stream.readline().rstrip(b'\n')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 2:
+        sys.stderr.write('usage: kbtt_client.py unix:/path | host:port\n')
+        sys.exit(2)
+    if sys.stdin.isatty():
+        sys.stdout.write('{"error": "Input stream is unavailable."}')
+    else:
+        result = request(sys.argv[1], sys.stdin.buffer.read())
+        sys.stdout.write(result.decode() or
+                         '{"error": "No response from the server."}')
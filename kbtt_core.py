@@ -0,0 +1,2130 @@
+import os
+import sys
+import json
+import functools
+import math
+import mmap
+import time
+import struct
+import heapq
+import bisect
+import operator
+import itertools
+import collections
+
+# columnar engine dependency is optional and imported on first use, as
+# numpy alone would double the command line startup time
+numpy = None
+
+
+get_time = operator.itemgetter('c')
+
+
+class EventType:
+    START = 's'
+    END = 'e'
+    PAUSE = 'p'
+    UNPAUSE = 'u'
+    CONNECT = 'c'
+    DISCONNECT = 'd'
+
+
+EVENT_TYPES = (EventType.START, EventType.END, EventType.PAUSE,
+               EventType.UNPAUSE, EventType.CONNECT, EventType.DISCONNECT,)
+DEVICE_EVENT_TYPES = (EventType.CONNECT, EventType.DISCONNECT,)
+
+# TrackingSession.snapshot format version
+SNAPSHOT_VERSION = 1
+
+# binary event log header and record layouts, header time codes are "q"
+# for int, "d" for float and "m" for mixed times
+LOG_MAGIC = b'KBTL'
+LOG_VERSION = 1
+LOG_HEADER = struct.Struct('<4sBcxxQQ')
+LOG_RECORD = '<%sIIB'
+LOG_TIME_FORMATS = {'q': 'q', 'd': 'd', 'm': 'd'}
+
+# json backends in default order, the first installed one is the default,
+# fast ones are optional and only the picked one is imported, by default
+# not before a payload large enough to pay off its import
+JSON_BACKENDS = ('orjson', 'msgspec', 'json',)
+JSON_ERRORS = (json.JSONDecodeError, UnicodeDecodeError,)
+
+
+class InvalidEventError(ValueError):
+    pass
+
+
+@functools.lru_cache()
+def import_json_backend(name=None):
+    # loads and decode errors of the named or the default json backend
+    for backend in (name,) if name else JSON_BACKENDS:
+        try:
+            if backend == 'orjson':
+                import orjson
+                return orjson.loads, JSON_ERRORS
+            if backend == 'msgspec':
+                import msgspec
+                return msgspec.json.decode, JSON_ERRORS + (
+                    msgspec.DecodeError,)
+        except ImportError:
+            if name:
+                raise
+            continue
+        if backend == 'json':
+            return json.loads, JSON_ERRORS
+    raise ValueError('Unknown json backend %r.' % name)
+
+
+class Event:
+    # compact typed event record, "u" and "d" are None for app events,
+    # item access keeps it usable with code written for event dicts
+    __slots__ = ('t', 'c', 'u', 'd',)
+
+    def __init__(self, t, c, u=None, d=None):
+        self.t, self.c, self.u, self.d = t, c, u, d
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+    def __eq__(self, other):
+        if isinstance(other, Event):
+            other = other.to_dict()
+        return self.to_dict() == other
+
+    def __repr__(self):
+        return 'Event(%r)' % self.to_dict()
+
+    def __reduce__(self):
+        # pickled as constructor arguments, faster than slots state
+        return Event, (self.t, self.c, self.u, self.d)
+
+    def to_dict(self):
+        if self.t in DEVICE_EVENT_TYPES:
+            return {'t': self.t, 'c': self.c, 'u': self.u, 'd': self.d}
+        return {'t': self.t, 'c': self.c}
+
+
+class AppState:
+    IDLE = 0
+    IN_PROGRESS = 1
+    PAUSED = 2
+
+
+class DeviceState:
+    def __init__(self):
+        self.last_event = None
+        self.last_connected = None
+
+    def copy(self):
+        state = DeviceState()
+        state.last_event, state.last_connected = (self.last_event,
+                                                  self.last_connected)
+        return state
+
+
+class ReduceState:
+    def __init__(self):
+        self.tracked_time = 0
+        self.connected_devices = {}
+        self.user_devices = {}
+        self.connected_users = 0
+        self.last_both_connected = None
+        self.last_active = None
+        self.paused = False
+        self.state_time = None
+        self.ended = False
+
+    def copy(self):
+        state = ReduceState()
+        state.__dict__.update(self.__dict__)
+        state.connected_devices = dict(self.connected_devices)
+        state.user_devices = dict(self.user_devices)
+        return state
+
+
+class Profile:
+    # profiling hook collecting stage stats of TimeTracker calls
+    def __init__(self):
+        self.stages = []
+
+    def __call__(self, stage, stats):
+        self.stages.append(dict(stage=stage, **stats))
+
+
+class TimeTracker:
+    # decoded events type and their time key, item lookups of dicts are
+    # faster than record ones in this pipeline, engines reading attributes
+    # use Event
+    record = dict
+    get_time = get_time
+    # sessions with at least as many devices and device events flatten
+    # device streams in executor tasks of about group_events events each
+    parallel_devices = 256
+    parallel_events = 200000
+    group_events = 25000
+
+    def __init__(self, min_users=2, hooks=(), json_backend=None,
+                 executor=None):
+        # distinct connected users required to track time
+        self.min_users = min_users
+        # hook(stage, stats) callables, stages are timed only if any
+        self.hooks = list(hooks)
+        # json module until the default backend is picked by loads
+        self.json_errors = JSON_ERRORS
+        if json_backend is not None:
+            self.loads, self.json_errors = import_json_backend(json_backend)
+        # concurrent.futures executor for large sessions, serial if None
+        self.executor = executor
+
+    # payload size the default json backend is picked from, importing a
+    # fast one costs more than it saves on smaller payloads
+    fast_json_size = 2 ** 20
+
+    def loads(self, value):
+        if len(value) < self.fast_json_size:
+            return json.loads(value)
+        # replaced for the following payloads too
+        self.loads, self.json_errors = import_json_backend()
+        return self.loads(value)
+
+    def add_hook(self, hook):
+        self.hooks.append(hook)
+
+    def notify(self, stage, started, events_in, events_out, finished=None,
+               **stats):
+        # stages computing their stats pass the time they finished at, so
+        # the stats aren't timed as part of them
+        if finished is None:
+            finished = time.perf_counter()
+        stats.update(time=finished - started, events_in=events_in,
+                     events_out=events_out)
+        for hook in self.hooks:
+            hook(stage, stats)
+        return time.perf_counter()
+
+    def track(self, value, intervals=False):
+        started = self.hooks and time.perf_counter()
+        try:
+            value, events = self.decode(value)
+        except InvalidEventError as error:
+            return {'error': str(error)}
+        if self.hooks:
+            self.notify('decode', started, None, len(events))
+        return self.track_events(events, value['ttl'], value['currentTime'],
+                                 intervals)
+
+    def track_log(self, log, intervals=False):
+        # tracks a binary EventLog, events are read without JSON decoding
+        started = self.hooks and time.perf_counter()
+        events = self.read_log(log)
+        if self.hooks:
+            self.notify('read_log', started, None, len(events))
+        return self.track_events(events, log.ttl, log.current_time, intervals)
+
+    def track_events(self, events, ttl, current_time, intervals=False,
+                     in_place=False):
+        # in place the events list is owned by the call and sorted in place
+        events = self.flatten_event_stream(events, ttl, current_time,
+                                           in_place)
+        started = self.hooks and time.perf_counter()
+        tracked = [] if intervals else None
+        result = self.reduce_events(events, intervals=tracked)
+        if self.hooks:
+            self.notify('reduce_events', started, len(events), None)
+        if intervals:
+            result['intervals'] = tracked
+        return result
+
+    def sweep_ttl(self, value, ttls):
+        # track results for each of ttls, events are decoded, sorted and
+        # split into device streams once and device connect gaps found once
+        # are compared with each ttl
+        try:
+            value, events = self.decode(value)
+        except InvalidEventError as error:
+            return {'error': str(error)}
+        if not all(type(ttl) in (int, float,) for ttl in ttls):
+            return {'error': 'Invalid ttl or currentTime value.'}
+
+        events = sorted(events, key=self.get_time)
+        device_streams, other_events = self.find_device_streams(events)
+        gaps = [self.find_device_gaps(devices)
+                for devices in device_streams.values()]
+
+        results = []
+        for ttl in ttls:
+            streams = [other_events]
+            for device_gaps in gaps:
+                streams.append(self.flatten_device_gaps(
+                    device_gaps, ttl, value['currentTime']))
+            results.append(dict(ttl=ttl, **self.reduce_events(
+                self.merge_event_streams(streams))))
+        return results
+
+    def track_users(self, value):
+        # track result with tracked intervals of each user, the tracked
+        # time the user had a device connected, as [user, intervals] pairs
+        try:
+            value, events = self.decode(value)
+        except InvalidEventError as error:
+            return {'error': str(error)}
+
+        events = self.flatten_event_stream(events, value['ttl'],
+                                           value['currentTime'])
+        intervals = []
+        result = self.reduce_events(events, intervals=intervals)
+        result['users'] = [
+            [user, intersect_intervals(spans, intervals)]
+            for user, spans in self.find_user_spans(events).items()
+        ]
+        return result
+
+    def track_ndjson(self, lines, chunk_size=1024, lateness=None):
+        # first line is a {"ttl", "currentTime"} header, then one event per
+        # line in time order, memory depends on devices count only, with
+        # lateness events are reordered up to it and later ones are counted,
+        # lines are read lazily and no more chunks once the session ended,
+        # currentTime is required as expiry disconnects are emitted as
+        # events go and can't be taken back for a null one
+        lines = (line for line in lines if line.strip())
+        try:
+            value = self.loads(next(lines, 'null'))
+        except self.json_errors:
+            value = None
+
+        if not (isinstance(value, dict) and
+                all([i in value for i in ('ttl', 'currentTime',)]) and
+                self.is_valid_header(value)):
+            return {'error': 'Invalid header line. JSON object is allowed.'}
+        if value['currentTime'] is None:
+            return {'error': 'Invalid currentTime value. Number is required.'}
+
+        session, count = TrackingSession(value['ttl'], self), 0
+        buffer = None if lateness is None else ReorderBuffer(session, lateness)
+        events = map(self.loads, lines)
+        try:
+            while True:
+                chunk = list(itertools.islice(events, chunk_size))
+                if not chunk:
+                    break
+                if buffer is None:
+                    session.extend(self.decode_events(chunk, count))
+                else:
+                    buffer.push(self.decode_events(chunk, count))
+                count += len(chunk)
+                if session.ended:
+                    break
+            if buffer is not None:
+                buffer.flush()
+        except InvalidEventError as error:
+            return {'error': str(error)}
+        except self.json_errors:
+            return {'error': 'Invalid event line. JSON object is allowed.'}
+        except ValueError:
+            return {'error': 'Events should be ordered by time.'}
+
+        if session.time is not None and value['currentTime'] < session.time:
+            return {'error': 'Current time precedes events.'}
+        result = session.result(value['currentTime'])
+        if buffer is None:
+            return result
+        return dict(result, lateEvents=buffer.late)
+
+    def convert_log(self, value, path, compact=False):
+        # writes a track value to a binary event log file, compacted ones
+        # keep only events that can change the track result
+        try:
+            value, events = self.decode(value)
+        except InvalidEventError as error:
+            return {'error': str(error)}
+        if not compact:
+            write_event_log(path, events, value['ttl'], value['currentTime'])
+            return {'events': len(events)}
+        compacted = self.compact_events(events, value['ttl'])
+        write_event_log(path, compacted, value['ttl'], value['currentTime'])
+        return {'events': len(compacted),
+                'droppedEvents': len(events) - len(compacted)}
+
+    def compact(self, value):
+        # track value with compacted events
+        try:
+            value, events = self.decode(value)
+        except InvalidEventError as error:
+            return {'error': str(error)}
+        return {
+            'events': [i if type(i) is dict else i.to_dict()
+                       for i in self.compact_events(events, value['ttl'])],
+            'ttl': value['ttl'],
+            'currentTime': value['currentTime'],
+        }
+
+    def compact_log(self, log, path):
+        # rewrites an EventLog compacted to the path, which may be its own
+        events = log.events(self.record)
+        compacted = self.compact_events(events, log.ttl)
+        write_event_log(path + '.tmp', compacted, log.ttl, log.current_time)
+        os.replace(path + '.tmp', path)
+        return {'events': len(compacted),
+                'droppedEvents': len(events) - len(compacted)}
+
+    # decode methods
+    def decode(self, value, start=0):
+        # returns the validated track value and its decoded events from the
+        # start index on, events parsed here are decoded in place
+        in_place = isinstance(value, (str, bytes,)) and not start
+        if isinstance(value, (str, bytes,)):
+            try:
+                value = self.loads(value)
+            except self.json_errors:
+                value = None
+
+        if not (isinstance(value, dict) and
+                all([i in value for i in ('events', 'ttl', 'currentTime',)])):
+            raise InvalidEventError(
+                'Invalid input value. JSON or dict are allowed.')
+        if not self.is_valid_header(value):
+            raise InvalidEventError('Invalid ttl or currentTime value.')
+        events = value['events']
+        if start and isinstance(events, list):
+            events = events[start:]
+        return value, self.decode_events(events, start, in_place)
+
+    def read_log(self, log):
+        return log.events(self.record)
+
+    def is_valid_header(self, value):
+        return (type(value['ttl']) in (int, float,) and
+                type(value['currentTime']) in (int, float, type(None),))
+
+    def decode_events(self, events, start=0, in_place=False):
+        # validates events in one pass and returns them as records, string
+        # ids of records are interned, in place the records replace events
+        if not isinstance(events, list):
+            raise InvalidEventError('Invalid events value. List is allowed.')
+
+        record, intern = self.record, sys.intern
+        result = events if record is dict or in_place else []
+        types, device_types = set(EVENT_TYPES), set(DEVICE_EVENT_TYPES)
+        numbers, ids = {int, float}, {str, int, float}
+        for index, event in enumerate(events, start):
+            if not (type(event) is dict and event.get('t') in types and
+                    type(event.get('c')) in numbers and
+                    (event['t'] not in device_types or
+                     type(event.get('u')) in ids and
+                     type(event.get('d')) in ids)):
+                raise InvalidEventError('Invalid event at index %s.' % index)
+            if record is not dict:
+                user, device = event.get('u'), event.get('d')
+                if type(user) is str:
+                    user = intern(user)
+                if type(device) is str:
+                    device = intern(device)
+                event = record(event['t'], event['c'], user, device)
+                if in_place:
+                    result[index - start] = event
+                else:
+                    result.append(event)
+        return result
+
+    # event checkers
+    def is_device_event(self, event):
+        return event['t'] in (EventType.CONNECT, EventType.DISCONNECT,)
+
+    def is_connect_event(self, event):
+        return event['t'] == EventType.CONNECT
+
+    def is_disconnect_event(self, event):
+        return event['t'] == EventType.DISCONNECT
+
+    def is_pause_event(self, event):
+        return event['t'] == EventType.PAUSE
+
+    def is_unpause_event(self, event):
+        return event['t'] == EventType.UNPAUSE
+
+    def is_start_event(self, event):
+        return event['t'] == EventType.START
+
+    def is_end_event(self, event):
+        return event['t'] == EventType.END
+
+    # compact methods
+    def compact_events(self, events, ttl):
+        # sorted events without ones that can't change the track result:
+        # events after the end, repeated pause and unpause events, repeated
+        # starts and device disconnects and, if ttl is above 0, connects
+        # flatten_device_stream would ignore, a heartbeat connect is only
+        # dropped if the next device event is within ttl of the last kept
+        # connect, so the ignored connect doesn't move the expiry
+        started = self.hooks and time.perf_counter()
+        events = sorted(events, key=self.get_time)
+        result, device_streams, starts, paused = [], {}, set(), False
+        for event in events:
+            if self.is_device_event(event):
+                if event['d'] not in device_streams:
+                    device_streams[event['d']] = []
+                device_streams[event['d']].append(len(result))
+            elif self.is_start_event(event):
+                if event['c'] in starts:
+                    continue
+                starts.add(event['c'])
+            elif self.is_pause_event(event):
+                if paused:
+                    continue
+                paused = True
+            elif self.is_unpause_event(event):
+                if not paused:
+                    continue
+                paused = False
+            result.append(event)
+            if self.is_end_event(event):
+                break
+
+        for indexes in device_streams.values():
+            last_event = last_connected = None
+            for position, index in enumerate(indexes):
+                event = result[index]
+                if not self.is_connect_event(event):
+                    if (last_event is not None and
+                            not self.is_connect_event(last_event)):
+                        result[index] = None
+                    else:
+                        last_event = event
+                    continue
+
+                if (ttl > 0 and last_event is not None and
+                        self.is_connect_event(last_event)):
+                    if (event['c'] == last_connected or
+                            position + 1 < len(indexes) and
+                            self.get_time(result[indexes[position + 1]]) -
+                            last_connected < ttl):
+                        result[index] = None
+                        continue
+                last_event, last_connected = event, event['c']
+
+        result = [i for i in result if i is not None]
+        if self.hooks:
+            self.notify('compact_events', started, len(events), len(result))
+        return result
+
+    # flatten methods
+    def flatten_event_stream(self, events, ttl, current_time=None,
+                             in_place=False):
+        started = self.hooks and time.perf_counter()
+        # timsort is linear on already sorted input
+        if in_place:
+            events.sort(key=self.get_time)
+        else:
+            events = sorted(events, key=self.get_time)
+        if self.hooks:
+            started = self.notify('sort', started, len(events), len(events))
+
+        device_streams, other_events = self.find_device_streams(events)
+        if self.hooks:
+            started = self.notify(
+                'find_device_streams', started, len(events),
+                sum(map(len, device_streams.values())) + len(other_events),
+                time.perf_counter())
+
+        streams = [other_events]
+        streams.extend(self.flatten_device_streams(
+            list(device_streams.values()), ttl, current_time))
+        if self.hooks:
+            finished = time.perf_counter()
+            real = set(map(id, events))
+            started = self.notify(
+                'flatten_device_stream', started,
+                sum(map(len, device_streams.values())),
+                sum(map(len, streams[1:])), finished,
+                devices=len(device_streams),
+                synthesized=sum(id(i) not in real
+                                for stream in streams for i in stream))
+
+        result = self.merge_event_streams(streams)
+        if self.hooks:
+            self.notify('merge_event_streams', started, len(result),
+                        len(result))
+        return result
+
+    def merge_event_streams(self, streams):
+        # each stream is sorted by time, so timsort only merges k runs in
+        # O(n log k) and keeps ties in streams order, like heapq.merge but
+        # in C and without a per-event heap operation
+        result = list(itertools.chain.from_iterable(streams))
+        result.sort(key=self.get_time)
+        return result
+
+    def find_device_streams(self, events):
+        device_streams, other_events = {}, []
+
+        paused = False
+        for event in events:
+            if self.is_device_event(event):
+                if event['d'] not in device_streams:
+                    device_streams[event['d']] = []
+                device_streams[event['d']].append(event)
+            else:
+                ignore = False
+                if self.is_pause_event(event):
+                    ignore = paused
+                    paused = True
+                elif self.is_unpause_event(event):
+                    ignore = not paused
+                    paused = False
+                if not ignore:
+                    other_events.append(event)
+                if self.is_end_event(event):
+                    break
+
+        return device_streams, other_events
+
+    def flatten_device_stream(self, events, ttl, current_time=None,
+                              state=None):
+        if state is None:
+            if not events:
+                return []
+            state = DeviceState()
+
+        result = []
+        last_event, last_connected = state.last_event, state.last_connected
+        if last_event is None and events:
+            last_event = events[0]
+            result.append(last_event)
+            if self.is_connect_event(last_event):
+                last_connected = last_event['c']
+
+        for event in events:
+            if self.is_connect_event(event):
+                ignore = False
+                if (self.is_connect_event(last_event) and
+                        last_connected is not None):
+                    if event['c'] - last_connected < ttl:
+                        ignore = True
+                    else:
+                        result.append({
+                            't': 'd',
+                            'c': last_connected + ttl / 2,
+                            'u': event['u'],
+                            'd': event['d']
+                        })
+                if not ignore:
+                    result.append(event)
+                    last_event = event
+                last_connected = event['c']
+
+            elif self.is_disconnect_event(event):
+                if (self.is_connect_event(last_event) and
+                        last_connected is not None and
+                        event['c'] - last_connected >= ttl):
+                    last_event = {
+                        't': 'd',
+                        'c': last_connected + ttl / 2,
+                        'u': event['u'],
+                        'd': event['d'],
+                    }
+                    result.append(last_event)
+                elif not self.is_disconnect_event(last_event):
+                    result.append(event)
+                    last_event = event
+
+        if (last_event is not None and self.is_connect_event(last_event) and
+                last_connected is not None and current_time is not None and
+                current_time - last_connected >= ttl):
+            last_event = {
+                't': 'd',
+                'c': last_connected + ttl / 2,
+                'u': last_event['u'],
+                'd': last_event['d'],
+            }
+            result.append(last_event)
+
+        state.last_event, state.last_connected = last_event, last_connected
+        return result
+
+    def flatten_device_streams(self, streams, ttl, current_time=None):
+        # flattened streams in order, serially or for large sessions in
+        # executor tasks of device groups, task results refer to events of
+        # the streams by index, so they are returned as is
+        if (self.executor is None or len(streams) < self.parallel_devices or
+                sum(map(len, streams)) < self.parallel_events):
+            return [self.flatten_device_stream(devices, ttl, current_time)
+                    for devices in streams]
+
+        groups, size = [[]], 0
+        for devices in streams:
+            if size >= self.group_events:
+                groups.append([])
+                size = 0
+            groups[-1].append(devices)
+            size += len(devices)
+        futures = [self.executor.submit(flatten_device_group, type(self),
+                                        group, ttl, current_time)
+                   for group in groups]
+
+        result = []
+        for group, future in zip(groups, futures):
+            for devices, flattened in zip(group, future.result()):
+                result.append([devices[i] if type(i) is int else i
+                               for i in flattened])
+        return result
+
+    def find_device_gaps(self, events):
+        # ttl independent part of flatten_device_stream: each event with
+        # whether the previous one was a connect (the first event counts as
+        # its own previous one), the last connect time and the gap to it
+        steps, last_connected = [], None
+        prev_connect = self.is_connect_event(events[0])
+        if prev_connect:
+            last_connected = events[0]['c']
+        for event in events:
+            connect = self.is_connect_event(event)
+            steps.append((event, connect, prev_connect, last_connected,
+                          None if last_connected is None else
+                          event['c'] - last_connected))
+            prev_connect = connect
+            if connect:
+                last_connected = event['c']
+        return steps, prev_connect, last_connected
+
+    def disconnect_event(self, time, user, device):
+        # synthesized ttl-expiry disconnect
+        return {'t': EventType.DISCONNECT, 'c': time, 'u': user, 'd': device}
+
+    def flatten_device_gaps(self, gaps, ttl, current_time=None):
+        # flatten_device_stream over find_device_gaps of the stream
+        steps, last_connect, last_connected = gaps
+        last_event = steps[0][0]
+        result = [last_event]
+        for event, connect, prev_connect, connected, gap in steps:
+            if connect:
+                if prev_connect:
+                    if gap < ttl:
+                        continue
+                    result.append(self.disconnect_event(
+                        connected + ttl / 2, event['u'], event['d']))
+                result.append(event)
+                last_event = event
+            elif prev_connect:
+                if gap >= ttl:
+                    result.append(self.disconnect_event(
+                        connected + ttl / 2, event['u'], event['d']))
+                else:
+                    result.append(event)
+
+        if (last_connect and current_time is not None and
+                current_time - last_connected >= ttl):
+            result.append(self.disconnect_event(
+                last_connected + ttl / 2, last_event['u'], last_event['d']))
+        return result
+
+    # reduce methods
+    def find_user_spans(self, events):
+        # [start, end] spans of flattened events each user had a device
+        # connected, up to the end event like reduce_events, spans still
+        # open are closed at infinity
+        connected_devices, user_devices, spans = {}, {}, {}
+
+        def connect(user, time):
+            user_devices[user] = user_devices.get(user, 0) + 1
+            if user_devices[user] == 1:
+                user_spans = spans.setdefault(user, [])
+                if user_spans and user_spans[-1][1] == time:
+                    user_spans[-1][1] = math.inf
+                else:
+                    user_spans.append([time, math.inf])
+
+        def disconnect(user, time):
+            user_devices[user] -= 1
+            if not user_devices[user]:
+                del user_devices[user]
+                spans[user][-1][1] = time
+
+        for event in events:
+            if self.is_connect_event(event):
+                if event['d'] in connected_devices:
+                    disconnect(connected_devices[event['d']], event['c'])
+                connected_devices[event['d']] = event['u']
+                connect(event['u'], event['c'])
+            elif self.is_disconnect_event(event):
+                disconnect(connected_devices.pop(event['d']), event['c'])
+            elif self.is_end_event(event):
+                break
+        return spans
+
+    def is_both_connected(self, connected_devices):
+        return len(set(connected_devices.values())) >= self.min_users
+
+    def reduce_events(self, events, state=None, intervals=None):
+        # closed tracked intervals are appended to the intervals list
+        if state is None:
+            state = ReduceState()
+        if state.ended:
+            events = ()
+
+        # connected devices are counted per user, so connected users count
+        # is updated in constant time per event
+        min_users = self.min_users
+        tracked_time = state.tracked_time
+        connected_devices = state.connected_devices
+        user_devices = state.user_devices
+        connected_users = state.connected_users
+        last_both_connected = state.last_both_connected
+        last_active = state.last_active
+        paused = state.paused
+        state_time = state.state_time
+        for event in events:
+            if self.is_connect_event(event):
+                prev_connected = connected_users >= min_users
+                if event['d'] in connected_devices:
+                    user = connected_devices[event['d']]
+                    user_devices[user] -= 1
+                    if not user_devices[user]:
+                        del user_devices[user]
+                        connected_users -= 1
+                user = connected_devices[event['d']] = event['u']
+                if user in user_devices:
+                    user_devices[user] += 1
+                else:
+                    user_devices[user] = 1
+                    connected_users += 1
+                if (not prev_connected and not paused and
+                        connected_users >= min_users):
+                    last_both_connected = event['c']
+                    last_active = event['c']
+            elif self.is_disconnect_event(event):
+                prev_connected = connected_users >= min_users
+                user = connected_devices.pop(event['d'])
+                user_devices[user] -= 1
+                if not user_devices[user]:
+                    del user_devices[user]
+                    connected_users -= 1
+                if (prev_connected and
+                        last_both_connected is not None and not paused and
+                        connected_users < min_users):
+                    tracked_time += event['c'] - last_both_connected
+                    if intervals is not None:
+                        intervals.append([last_both_connected, event['c']])
+                    last_both_connected = None
+            elif self.is_pause_event(event):
+                if last_both_connected is not None and not paused:
+                    tracked_time += event['c'] - last_both_connected
+                    if intervals is not None:
+                        intervals.append([last_both_connected, event['c']])
+                    last_both_connected = None
+                paused = True
+            elif self.is_unpause_event(event):
+                if connected_users >= min_users:
+                    last_both_connected = event['c']
+                    last_active = event['c']
+                paused = False
+            elif self.is_end_event(event):
+                if last_both_connected is not None and not paused:
+                    tracked_time += event['c'] - last_both_connected
+                    if intervals is not None:
+                        intervals.append([last_both_connected, event['c']])
+                    last_both_connected = None
+                state.ended = True
+                break
+
+            state_time = event['c']
+
+        state.tracked_time = tracked_time
+        state.connected_users = connected_users
+        state.last_both_connected = last_both_connected
+        state.last_active = last_active
+        state.paused = paused
+        state.state_time = state_time
+
+        state = AppState.IDLE
+        if paused:
+            state = AppState.PAUSED
+        elif connected_users >= min_users:
+            state = AppState.IN_PROGRESS
+
+        return {
+            'trackedTime': tracked_time,
+            'lastActive': last_active,
+            'stateTime': state_time,
+            'state': state,
+        }
+
+
+class TableTimeTracker(TimeTracker):
+    # the same pipeline with event types mapped once per event to the codes
+    # of a transition table and state kept in locals, so hot loops make no
+    # per-event checker method calls, event fields are read by the getters
+    # of the record type, so record engines share the loops
+    START, END, PAUSE, UNPAUSE, CONNECT, DISCONNECT = range(6)
+    codes = {t: n for n, t in enumerate(EVENT_TYPES)}
+    get_type = operator.itemgetter('t')
+    get_user = operator.itemgetter('u')
+    get_device = operator.itemgetter('d')
+
+    def find_device_streams(self, events):
+        codes, CONNECT, DISCONNECT, PAUSE, UNPAUSE, END = (
+            self.codes, self.CONNECT, self.DISCONNECT, self.PAUSE,
+            self.UNPAUSE, self.END)
+        get_type, get_device = self.get_type, self.get_device
+        device_streams, other_events = {}, []
+
+        paused = False
+        for event in events:
+            code = codes[get_type(event)]
+            if code == CONNECT or code == DISCONNECT:
+                device = get_device(event)
+                stream = device_streams.get(device)
+                if stream is None:
+                    device_streams[device] = [event]
+                else:
+                    stream.append(event)
+            elif code == PAUSE:
+                if not paused:
+                    other_events.append(event)
+                paused = True
+            elif code == UNPAUSE:
+                if paused:
+                    other_events.append(event)
+                paused = False
+            else:
+                other_events.append(event)
+                if code == END:
+                    break
+
+        return device_streams, other_events
+
+    def flatten_device_stream(self, events, ttl, current_time=None,
+                              state=None):
+        if state is None:
+            if not events:
+                return []
+            state = DeviceState()
+        codes, CONNECT = self.codes, self.CONNECT
+        get_type, get_time = self.get_type, self.get_time
+        get_user, get_device = self.get_user, self.get_device
+        disconnect_event = self.disconnect_event
+
+        result = []
+        append = result.append
+        last_event, last_connected = state.last_event, state.last_connected
+        if last_event is None and events:
+            last_event = events[0]
+            append(last_event)
+            if codes[get_type(last_event)] == CONNECT:
+                last_connected = get_time(last_event)
+
+        # the only state of the table: whether the last event is a connect
+        connected = (last_event is not None and
+                     codes[get_type(last_event)] == CONNECT)
+        for event in events:
+            if codes[get_type(event)] == CONNECT:
+                if connected and last_connected is not None:
+                    if get_time(event) - last_connected < ttl:
+                        last_connected = get_time(event)
+                        continue
+                    append(disconnect_event(last_connected + ttl / 2,
+                                            get_user(event),
+                                            get_device(event)))
+                append(event)
+                last_event, last_connected = event, get_time(event)
+                connected = True
+            elif connected:
+                if (last_connected is not None and
+                        get_time(event) - last_connected >= ttl):
+                    last_event = disconnect_event(last_connected + ttl / 2,
+                                                  get_user(event),
+                                                  get_device(event))
+                else:
+                    last_event = event
+                append(last_event)
+                connected = False
+
+        if (connected and last_connected is not None and
+                current_time is not None and
+                current_time - last_connected >= ttl):
+            last_event = disconnect_event(last_connected + ttl / 2,
+                                          get_user(last_event),
+                                          get_device(last_event))
+            append(last_event)
+
+        state.last_event, state.last_connected = last_event, last_connected
+        return result
+
+    def reduce_events(self, events, state=None, intervals=None):
+        if state is None:
+            state = ReduceState()
+        if state.ended:
+            events = ()
+        codes, CONNECT, DISCONNECT, PAUSE, UNPAUSE, END = (
+            self.codes, self.CONNECT, self.DISCONNECT, self.PAUSE,
+            self.UNPAUSE, self.END)
+        get_type, get_time = self.get_type, self.get_time
+        get_user, get_device = self.get_user, self.get_device
+
+        min_users = self.min_users
+        tracked_time = state.tracked_time
+        connected_devices = state.connected_devices
+        user_devices = state.user_devices
+        connected_users = state.connected_users
+        last_both_connected = state.last_both_connected
+        last_active = state.last_active
+        paused = state.paused
+        state_time = state.state_time
+        for event in events:
+            code = codes[get_type(event)]
+            if code == CONNECT:
+                prev_connected = connected_users >= min_users
+                device = get_device(event)
+                user = connected_devices.get(device)
+                if user is not None or device in connected_devices:
+                    count = user_devices[user] - 1
+                    if count:
+                        user_devices[user] = count
+                    else:
+                        del user_devices[user]
+                        connected_users -= 1
+                user = connected_devices[device] = get_user(event)
+                count = user_devices.get(user)
+                if count:
+                    user_devices[user] = count + 1
+                else:
+                    user_devices[user] = 1
+                    connected_users += 1
+                if (not prev_connected and not paused and
+                        connected_users >= min_users):
+                    last_both_connected = last_active = get_time(event)
+            elif code == DISCONNECT:
+                prev_connected = connected_users >= min_users
+                user = connected_devices.pop(get_device(event))
+                count = user_devices[user] - 1
+                if count:
+                    user_devices[user] = count
+                else:
+                    del user_devices[user]
+                    connected_users -= 1
+                if (prev_connected and
+                        last_both_connected is not None and not paused and
+                        connected_users < min_users):
+                    tracked_time += get_time(event) - last_both_connected
+                    if intervals is not None:
+                        intervals.append([last_both_connected,
+                                          get_time(event)])
+                    last_both_connected = None
+            elif code == PAUSE:
+                if last_both_connected is not None and not paused:
+                    tracked_time += get_time(event) - last_both_connected
+                    if intervals is not None:
+                        intervals.append([last_both_connected,
+                                          get_time(event)])
+                    last_both_connected = None
+                paused = True
+            elif code == UNPAUSE:
+                if connected_users >= min_users:
+                    last_both_connected = last_active = get_time(event)
+                paused = False
+            elif code == END:
+                if last_both_connected is not None and not paused:
+                    tracked_time += get_time(event) - last_both_connected
+                    if intervals is not None:
+                        intervals.append([last_both_connected,
+                                          get_time(event)])
+                    last_both_connected = None
+                state.ended = True
+                break
+
+            state_time = get_time(event)
+
+        state.tracked_time = tracked_time
+        state.connected_users = connected_users
+        state.last_both_connected = last_both_connected
+        state.last_active = last_active
+        state.paused = paused
+        state.state_time = state_time
+
+        state = AppState.IDLE
+        if paused:
+            state = AppState.PAUSED
+        elif connected_users >= min_users:
+            state = AppState.IN_PROGRESS
+
+        return {
+            'trackedTime': tracked_time,
+            'lastActive': last_active,
+            'stateTime': state_time,
+            'state': state,
+        }
+
+
+class CompactTimeTracker(TableTimeTracker):
+    # table engine over slotted Event records with interned string ids,
+    # events parsed from JSON are replaced by records in place and sorted
+    # in place, loops read attributes and synthesized disconnects are
+    # records too
+    record = Event
+    get_time = operator.attrgetter('c')
+    get_type = operator.attrgetter('t')
+    get_user = operator.attrgetter('u')
+    get_device = operator.attrgetter('d')
+
+    def track_events(self, events, ttl, current_time, intervals=False,
+                     in_place=True):
+        # decoded records are new lists, so sorting them can't be seen
+        return super().track_events(events, ttl, current_time, intervals,
+                                    in_place)
+
+    def disconnect_event(self, time, user, device):
+        return Event(EventType.DISCONNECT, time, user, device)
+
+
+class IntervalIndex:
+    # prefix sums over sorted disjoint [start, end] intervals, answers
+    # tracked time within a time range in O(log n)
+    def __init__(self, intervals):
+        self.starts = [i[0] for i in intervals]
+        self.ends = [i[1] for i in intervals]
+        self.prefix = [0]
+        for start, end in intervals:
+            self.prefix.append(self.prefix[-1] + (end - start))
+
+    def __len__(self):
+        return len(self.starts)
+
+    def covered(self, at):
+        # tracked time up to the moment
+        index = bisect.bisect_right(self.starts, at) - 1
+        if index < 0:
+            return 0
+        return self.prefix[index] + (min(at, self.ends[index]) -
+                                     self.starts[index])
+
+    def tracked_time(self, start=None, end=None):
+        total = self.prefix[-1] if end is None else self.covered(end)
+        if start is not None:
+            total -= self.covered(start)
+        return max(total, 0)
+
+
+def intersect_intervals(first, second):
+    # intersection of two sorted lists of disjoint [start, end] intervals
+    result, i, j = [], 0, 0
+    while i < len(first) and j < len(second):
+        start = max(first[i][0], second[j][0])
+        end = min(first[i][1], second[j][1])
+        if start < end:
+            result.append([start, end])
+        if first[i][1] < second[j][1]:
+            i += 1
+        else:
+            j += 1
+    return result
+
+
+class BucketAggregator:
+    # tracked time per user and time bucket, intervals are split at bucket
+    # boundaries, buckets are numbered from time 0 and aggregators of
+    # different workers are merged by summing their totals
+    def __init__(self, bucket_size=3600):
+        if not bucket_size > 0:
+            raise ValueError('Bucket size should be positive.')
+        self.bucket_size = bucket_size
+        self.totals = {}
+        self.sessions = 0
+        self.errors = 0
+
+    def add(self, user, intervals):
+        size, totals = self.bucket_size, self.totals
+        for start, end in intervals:
+            bucket = int(start // size)
+            while start < end:
+                stop = min(end, (bucket + 1) * size)
+                key = (user, bucket)
+                totals[key] = totals.get(key, 0) + (stop - start)
+                start, bucket = stop, bucket + 1
+
+    def add_result(self, result):
+        # adds a track_users result, errors are counted
+        if 'error' in result:
+            self.errors += 1
+            return
+        self.sessions += 1
+        for user, intervals in result['users']:
+            self.add(user, intervals)
+
+    def merge(self, other):
+        for key, value in other.totals.items():
+            self.totals[key] = self.totals.get(key, 0) + value
+        self.sessions += other.sessions
+        self.errors += other.errors
+
+    def rows(self):
+        # {"user", "bucket", "trackedTime"} rows, bucket is its start time
+        return [
+            {'user': user, 'bucket': bucket * self.bucket_size,
+             'trackedTime': value}
+            for (user, bucket), value in sorted(
+                self.totals.items(), key=lambda i: (str(i[0][0]), i[0][1]))
+        ]
+
+
+def import_numpy():
+    global numpy
+    if numpy is None:
+        import numpy as module
+        numpy = module
+    return numpy
+
+
+class EventColumns:
+    # columnar events: "t", "u" and "d" values are interned into tables and
+    # stored as codes, "t" codes follow EVENT_TYPES for the known types,
+    # ints flags int times among float ones, so they are restored as ints
+    def __init__(self, types, times, users, devices, tables, ints=None):
+        self.types, self.times = types, times
+        self.users, self.devices = users, devices
+        self.type_table, self.user_table, self.device_table = tables
+        self.ints = ints
+
+    def __len__(self):
+        return len(self.times)
+
+    @classmethod
+    def from_events(cls, events):
+        import_numpy()
+        tables = ({i: n for n, i in enumerate(EVENT_TYPES)}, {}, {})
+        types, users, devices = tables
+        times = [i['c'] for i in events]
+        columns = cls(
+            numpy.array([types.setdefault(i['t'], len(types))
+                         for i in events], dtype=numpy.int32),
+            numpy.array(times),
+            numpy.array([users.setdefault(i.get('u'), len(users))
+                         for i in events], dtype=numpy.int32),
+            numpy.array([devices.setdefault(i.get('d'), len(devices))
+                         for i in events], dtype=numpy.int32),
+            [list(i) for i in tables])
+        if not len(events):
+            columns.times = columns.times.astype(numpy.int64)
+        elif columns.times.dtype.kind == 'f' and int in set(map(type, times)):
+            columns.ints = numpy.array([type(i) is int for i in times])
+        return columns
+
+    def to_events(self, rows, synthesized, times):
+        # builds event dicts for rows, synthesized rows are ttl-expiry
+        # disconnects of the row device at the given times
+        types, users, devices = (self.type_table, self.user_table,
+                                 self.device_table)
+        codes, values = self.types.tolist(), self.times.tolist()
+        if self.ints is not None:
+            values = [int(c) if flag else c
+                      for c, flag in zip(values, self.ints.tolist())]
+        user_codes, device_codes = self.users.tolist(), self.devices.tolist()
+        device_types = (EVENT_TYPES.index(EventType.CONNECT),
+                        EVENT_TYPES.index(EventType.DISCONNECT),)
+
+        result = []
+        for row, synthesize, time in zip(rows.tolist(), synthesized.tolist(),
+                                         times.tolist()):
+            if synthesize:
+                result.append({
+                    't': EventType.DISCONNECT,
+                    'c': time,
+                    'u': users[user_codes[row]],
+                    'd': devices[device_codes[row]],
+                })
+            elif codes[row] in device_types:
+                result.append({
+                    't': types[codes[row]],
+                    'c': values[row],
+                    'u': users[user_codes[row]],
+                    'd': devices[device_codes[row]],
+                })
+            else:
+                result.append({'t': types[codes[row]], 'c': values[row]})
+        return result
+
+
+class ColumnarTimeTracker(TimeTracker):
+    # numpy engine, the same pipeline over EventColumns with per-device
+    # ttl gaps found by vectorized diffs and masks instead of event loops
+    START, END, PAUSE, UNPAUSE, CONNECT, DISCONNECT = range(6)
+
+    def __init__(self, *args, **kwargs):
+        import_numpy()
+        super().__init__(*args, **kwargs)
+
+    def read_log(self, log):
+        return log.columns()
+
+    def flatten_event_stream(self, events, ttl, current_time=None,
+                             in_place=False):
+        started = self.hooks and time.perf_counter()
+        columns = (events if isinstance(events, EventColumns) else
+                   EventColumns.from_events(events))
+        if self.hooks:
+            started = self.notify('from_events', started, len(events),
+                                  len(columns))
+
+        rows, synthesized, times = self.flatten_columns(columns, ttl,
+                                                        current_time)
+        if self.hooks:
+            started = self.notify('flatten_columns', started, len(columns),
+                                  len(rows),
+                                  synthesized=int(synthesized.sum()))
+
+        result = columns.to_events(rows, synthesized, times)
+        if self.hooks:
+            self.notify('to_events', started, len(rows), len(result))
+        return result
+
+    def flatten_columns(self, columns, ttl, current_time=None):
+        # returns rows, synthesized flags and times of flattened events
+        order = numpy.argsort(columns.times, kind='stable')
+        codes = columns.types[order]
+        end = numpy.flatnonzero(codes == self.END)
+        if len(end):
+            order, codes = order[:end[0] + 1], codes[:end[0] + 1]
+        device = (codes == self.CONNECT) | (codes == self.DISCONNECT)
+
+        # pause and unpause events are kept only when they switch state
+        others, codes = order[~device], codes[~device]
+        switch = (codes == self.PAUSE) | (codes == self.UNPAUSE)
+        paused = codes[switch] == self.PAUSE
+        keep = numpy.ones(len(others), dtype=bool)
+        keep[switch] = paused != numpy.concatenate(([False], paused[:-1]))
+        others = others[keep]
+
+        rows, synthesized, times, sequence = self.flatten_device_columns(
+            columns, order[device], ttl, current_time)
+
+        # stable merge by time of others followed by device streams
+        rows = numpy.concatenate((others, rows))
+        synthesized = numpy.concatenate(
+            (numpy.zeros(len(others), dtype=bool), synthesized))
+        times = numpy.concatenate(
+            (columns.times[others].astype(numpy.float64), times))
+        sequence = numpy.concatenate(
+            (numpy.arange(len(others)), sequence + len(others)))
+        merged = numpy.lexsort((sequence, times))
+        return rows[merged], synthesized[merged], times[merged]
+
+    def flatten_device_columns(self, columns, rows, ttl, current_time=None):
+        # device streams ordered by first appearance, as find_device_streams
+        _, first, inverse = numpy.unique(columns.devices[rows],
+                                         return_index=True,
+                                         return_inverse=True)
+        group = numpy.argsort(numpy.argsort(first))[inverse.ravel()]
+        stream = numpy.argsort(group, kind='stable')
+        rows, group = rows[stream], group[stream]
+        connect = columns.types[rows] == self.CONNECT
+        times = columns.times[rows]
+
+        # state before each event is the type of the previous raw event of
+        # its stream, and the first event is emitted then seen again
+        size = len(rows)
+        index = numpy.arange(size)
+        head = numpy.ones(size, dtype=bool)
+        head[1:] = group[1:] != group[:-1]
+        previous = index - 1
+        previous[head] = index[head]
+        was_connected = connect[previous]
+        expired = was_connected & (times - times[previous] >= ttl)
+        emitted = numpy.where(connect, ~was_connected | expired,
+                              was_connected & ~expired)
+
+        # output slots per event: first emit, expiry disconnect, emit
+        selected = numpy.stack((head, expired, emitted), axis=1).ravel()
+        source = numpy.repeat(index, 3)[selected]
+        time_source = numpy.stack((index, previous, index),
+                                  axis=1).ravel()[selected]
+        synthesized = numpy.tile([False, True, False], size)[selected]
+        sequence = 2 * numpy.arange(len(source))
+
+        # trailing expiry disconnect gets user of the last emitted event
+        if current_time is not None and size:
+            tail = numpy.flatnonzero(numpy.append(head[1:], True))
+            tail = tail[connect[tail] & (current_time - times[tail] >= ttl)]
+            last = numpy.flatnonzero(numpy.append(
+                group[source][1:] != group[source][:-1], True))
+            last = last[numpy.searchsorted(group[source][last], group[tail])]
+            source = numpy.concatenate((source, source[last]))
+            time_source = numpy.concatenate((time_source, tail))
+            synthesized = numpy.concatenate(
+                (synthesized, numpy.ones(len(tail), dtype=bool)))
+            sequence = numpy.concatenate((sequence, 2 * last + 1))
+
+        times = times[time_source].astype(numpy.float64)
+        times[synthesized] += ttl / 2
+        return rows[source], synthesized, times, sequence
+
+
+class EventLog:
+    # mmap reader of binary event logs: a header, fixed-width records of
+    # time, user and device codes and EVENT_TYPES index, then a JSON table
+    # with ttl, currentTime and interned ids, code 0 stands for no id
+    def __init__(self, path):
+        with open(path, 'rb') as file:
+            if os.fstat(file.fileno()).st_size < LOG_HEADER.size:
+                raise ValueError('Invalid event log.')
+            self.buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            magic, version, code, count, size = LOG_HEADER.unpack_from(
+                self.buffer)
+            self.code = code.decode()
+            if (magic != LOG_MAGIC or version != LOG_VERSION or
+                    self.code not in LOG_TIME_FORMATS):
+                raise ValueError
+            self.record = struct.Struct(
+                LOG_RECORD % LOG_TIME_FORMATS[self.code])
+            if len(self.buffer) != (LOG_HEADER.size + size +
+                                    self.record.size * count):
+                raise ValueError
+            table = json.loads(self.buffer[len(self.buffer) - size:])
+            self.ttl, self.current_time = table['ttl'], table['currentTime']
+            self.ids = table['ids']
+        except (LookupError, TypeError, ValueError):
+            self.close()
+            raise ValueError('Invalid event log.')
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.buffer.close()
+
+    def events(self, record=dict):
+        # events as dicts or records, app events have no user code
+        start = LOG_HEADER.size
+        types, ids = EVENT_TYPES, self.ids
+        with memoryview(self.buffer) as view:
+            records = self.record.iter_unpack(
+                view[start:start + self.record.size * self.count])
+            if self.code == 'm':
+                # int times among float ones are flagged in the type code
+                records = ((int(c) if t & 0x80 else c, u, d, t & 0x7f)
+                           for c, u, d, t in records)
+            if record is dict:
+                return [{'t': types[t], 'c': c, 'u': ids[u], 'd': ids[d]}
+                        if u else {'t': types[t], 'c': c}
+                        for c, u, d, t in records]
+            return [record(types[t], c, ids[u], ids[d])
+                    for c, u, d, t in records]
+
+    def columns(self):
+        import_numpy()
+        code = LOG_TIME_FORMATS[self.code]
+        records = numpy.frombuffer(self.buffer, numpy.dtype([
+            ('c', '<' + code), ('u', '<u4'), ('d', '<u4'), ('t', 'u1'),
+        ]), self.count, LOG_HEADER.size)
+        columns = EventColumns(
+            (records['t'] & 0x7f).astype(numpy.int32),
+            records['c'].astype(code),
+            records['u'].astype(numpy.int32),
+            records['d'].astype(numpy.int32),
+            (list(EVENT_TYPES), self.ids, self.ids),
+            (records['t'] & 0x80).astype(bool) if self.code == 'm' else None)
+        # copies above release the buffer, so the log can be closed
+        del records
+        return columns
+
+
+def write_event_log(path, events, ttl, current_time=None):
+    # times are stored as int64 if all of them are ints, float64 otherwise,
+    # int times among float ones are flagged to keep their type
+    ids, types = {None: 0}, {t: n for n, t in enumerate(EVENT_TYPES)}
+    kinds = {type(i['c']) for i in events}
+    if kinds <= {int} and all(-2 ** 63 <= i['c'] < 2 ** 63 for i in events):
+        code = 'q'
+    else:
+        code = 'm' if int in kinds else 'd'
+    record, records = struct.Struct(LOG_RECORD % LOG_TIME_FORMATS[code]), []
+    for event in events:
+        user = device = 0
+        if event['t'] in DEVICE_EVENT_TYPES:
+            user = ids.setdefault(event['u'], len(ids))
+            device = ids.setdefault(event['d'], len(ids))
+        flag = 0x80 if code == 'm' and type(event['c']) is int else 0
+        records.append(record.pack(event['c'], user, device,
+                                   types[event['t']] | flag))
+    table = json.dumps({'ttl': ttl, 'currentTime': current_time,
+                        'ids': list(ids)}, separators=(',', ':')).encode()
+
+    with open(path, 'wb') as file:
+        file.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, code.encode(),
+                                   len(events), len(table)))
+        file.write(b''.join(records))
+        file.write(table)
+
+
+class TrackingSession:
+    # Incremental counterpart of TimeTracker.track for append-only event
+    # logs: keeps flatten and reduce state between calls, so appending k
+    # events costs O(k) plus O(devices) instead of reprocessing the log.
+    #
+    # Appended events must not precede already appended ones and
+    # current_time must not precede the latest appended event (the usual
+    # polling contract). Flattened events are committed to the reducer
+    # only once no device can emit an earlier ttl-expiry disconnect.
+    def __init__(self, ttl, tracker=None):
+        self.ttl = ttl
+        self.tracker = tracker or TimeTracker()
+        self.time = None
+        self.paused = False
+        self.ended = False
+        self.devices = {}
+        self.pending = []
+        self.seq = 0
+        self.state = ReduceState()
+
+    def append(self, events, current_time):
+        self.extend(events)
+        return self.result(current_time)
+
+    def extend(self, events):
+        tracker, ttl = self.tracker, self.ttl
+        events = sorted(events, key=tracker.get_time)
+        if events and self.time is not None and events[0]['c'] < self.time:
+            raise ValueError('Events precede already appended ones.')
+
+        for event in events:
+            if self.ended:
+                break
+            if tracker.is_device_event(event):
+                if event['d'] not in self.devices:
+                    self.devices[event['d']] = (len(self.devices) + 1,
+                                                DeviceState())
+                index, state = self.devices[event['d']]
+                self.push(index, tracker.flatten_device_stream(
+                    [event], ttl, state=state))
+            else:
+                ignore = False
+                if tracker.is_pause_event(event):
+                    ignore = self.paused
+                    self.paused = True
+                elif tracker.is_unpause_event(event):
+                    ignore = not self.paused
+                    self.paused = False
+                if not ignore:
+                    self.push(0, [event])
+                if tracker.is_end_event(event):
+                    self.ended = True
+            self.time = event['c']
+
+        if self.time is not None:
+            # devices silent for ttl will emit their expiry disconnect
+            # either on the next event or on the trailing check
+            for index, state in self.devices.values():
+                self.push(index, tracker.flatten_device_stream(
+                    [], ttl, self.time, state))
+        self.commit()
+
+    def push(self, index, events):
+        for event in events:
+            heapq.heappush(self.pending, (event['c'], index, self.seq, event))
+            self.seq += 1
+
+    def commit(self):
+        watermark = self.time
+        for index, state in self.devices.values():
+            if self.is_expiring(state):
+                watermark = min(watermark, state.last_connected + self.ttl / 2)
+
+        events = []
+        while self.pending and self.pending[0][0] < watermark:
+            events.append(heapq.heappop(self.pending)[3])
+        self.tracker.reduce_events(events, self.state)
+
+    def is_expiring(self, state):
+        return (state.last_event is not None and
+                self.tracker.is_connect_event(state.last_event) and
+                state.last_connected is not None)
+
+    def result(self, current_time):
+        if self.time is not None and (current_time is None or
+                                      current_time < self.time):
+            raise ValueError('Current time precedes appended events.')
+
+        pending, seq = self.pending[:], self.seq
+        for index, state in self.devices.values():
+            if self.is_expiring(state):
+                for event in self.tracker.flatten_device_stream(
+                        [], self.ttl, current_time, state.copy()):
+                    pending.append((event['c'], index, seq, event))
+                    seq += 1
+        pending.sort()
+        return self.tracker.reduce_events([i[3] for i in pending],
+                                          self.state.copy())
+
+    def snapshot(self):
+        # JSON-compatible session state, events are kept as [t, c] or
+        # [t, c, u, d] lists, devices and their users as lists of pairs
+        # since their ids aren't necessarily strings
+        dump, state = self.dump_event, self.state
+        return {
+            'version': SNAPSHOT_VERSION,
+            'ttl': self.ttl,
+            'time': self.time,
+            'paused': self.paused,
+            'ended': self.ended,
+            'seq': self.seq,
+            'devices': [
+                [device, index, device_state.last_connected,
+                 None if device_state.last_event is None else
+                 dump(device_state.last_event)]
+                for device, (index, device_state) in self.devices.items()
+            ],
+            'pending': [[c, index, seq, dump(event)]
+                        for c, index, seq, event in self.pending],
+            'reduce': {
+                'trackedTime': state.tracked_time,
+                'connectedDevices': list(state.connected_devices.items()),
+                'userDevices': list(state.user_devices.items()),
+                'connectedUsers': state.connected_users,
+                'lastBothConnected': state.last_both_connected,
+                'lastActive': state.last_active,
+                'paused': state.paused,
+                'stateTime': state.state_time,
+                'ended': state.ended,
+            },
+        }
+
+    @classmethod
+    def restore(cls, snapshot, tracker=None):
+        if snapshot.get('version') != SNAPSHOT_VERSION:
+            raise ValueError('Unsupported snapshot version.')
+
+        session = cls(snapshot['ttl'], tracker)
+        load = session.load_event
+        session.time = snapshot['time']
+        session.paused = snapshot['paused']
+        session.ended = snapshot['ended']
+        session.seq = snapshot['seq']
+        for device, index, last_connected, last_event in snapshot['devices']:
+            device_state = DeviceState()
+            device_state.last_connected = last_connected
+            if last_event is not None:
+                device_state.last_event = load(last_event)
+            session.devices[device] = (index, device_state)
+        # already in heap order
+        session.pending = [(c, index, seq, load(event))
+                           for c, index, seq, event in snapshot['pending']]
+
+        state, reduce = session.state, snapshot['reduce']
+        state.tracked_time = reduce['trackedTime']
+        state.connected_devices = dict(reduce['connectedDevices'])
+        state.user_devices = dict(reduce['userDevices'])
+        state.connected_users = reduce['connectedUsers']
+        state.last_both_connected = reduce['lastBothConnected']
+        state.last_active = reduce['lastActive']
+        state.paused = reduce['paused']
+        state.state_time = reduce['stateTime']
+        state.ended = reduce['ended']
+        return session
+
+    def dump_event(self, event):
+        if event['t'] in DEVICE_EVENT_TYPES:
+            return [event['t'], event['c'], event['u'], event['d']]
+        return [event['t'], event['c']]
+
+    def load_event(self, fields):
+        if self.tracker.record is dict:
+            return dict(zip(('t', 'c', 'u', 'd'), fields))
+        return self.tracker.record(*fields)
+
+
+class SnapshotStore:
+    # sqlite table of compact session snapshots by session id, so a
+    # session resumes from its snapshot and the events appended since
+    def __init__(self, path=':memory:'):
+        import sqlite3  # store only, keeps cli startup short
+
+        self.connection = sqlite3.connect(path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS snapshots '
+                                '(id TEXT PRIMARY KEY, '
+                                'snapshot TEXT NOT NULL)')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def save(self, session_id, session):
+        snapshot = json.dumps(session.snapshot(), separators=(',', ':'))
+        with self.connection:
+            self.connection.execute(
+                'INSERT OR REPLACE INTO snapshots VALUES (?, ?)',
+                (session_id, snapshot))
+
+    def load(self, session_id, tracker=None):
+        row = self.connection.execute(
+            'SELECT snapshot FROM snapshots WHERE id = ?',
+            (session_id,)).fetchone()
+        if row is None:
+            return None
+        return TrackingSession.restore(json.loads(row[0]), tracker)
+
+    def delete(self, session_id):
+        with self.connection:
+            self.connection.execute('DELETE FROM snapshots WHERE id = ?',
+                                    (session_id,))
+
+    def close(self):
+        self.connection.close()
+
+
+class ReorderBuffer:
+    # Streaming front of TrackingSession for events delivered out of
+    # order: holds events in a heap and releases them in time order once
+    # the watermark, the latest pushed time minus lateness, passes them.
+    # Events older than the watermark are returned and counted as late
+    # instead of being tracked.
+    def __init__(self, session, lateness):
+        self.session = session
+        self.lateness = lateness
+        self.pending = []
+        self.seq = 0
+        self.latest = None
+        self.late = 0
+
+    @property
+    def watermark(self):
+        # held events up to it are released, earlier pushed ones are late
+        watermark = self.session.time
+        if self.latest is not None and (
+                watermark is None or self.latest - self.lateness > watermark):
+            watermark = self.latest - self.lateness
+        return watermark
+
+    def push(self, events):
+        late, watermark = [], self.watermark
+        for event in events:
+            if watermark is not None and event['c'] < watermark:
+                late.append(event)
+                continue
+            # equal times are released in push order, as sorted() keeps them
+            heapq.heappush(self.pending, (event['c'], self.seq, event))
+            self.seq += 1
+            if self.latest is None or event['c'] > self.latest:
+                self.latest = event['c']
+                watermark = self.watermark
+
+        self.late += len(late)
+        if watermark is not None:
+            self.release(watermark)
+        return late
+
+    def release(self, watermark):
+        events = []
+        while self.pending and self.pending[0][0] <= watermark:
+            events.append(heapq.heappop(self.pending)[2])
+        if events:
+            self.session.extend(events)
+
+    def flush(self):
+        # releases all held events, e.g. at the end of the stream
+        if self.pending:
+            self.release(self.latest)
+
+    def result(self, current_time):
+        # result of released events only
+        return self.session.result(current_time)
+
+
+class TrackerCache:
+    # LRU of TrackingSession by session id for clients polling track with
+    # the same growing event list and a later currentTime: only events
+    # past the cached count are decoded and appended, so a poll with new
+    # currentTime only costs O(devices) plus the ttl window of events.
+    #
+    # The cached prefix is assumed unchanged if the event count didn't
+    # shrink and its last event is the same, sessions are rebuilt from all
+    # events otherwise or when new events precede the cached ones.
+    def __init__(self, tracker=None, size=1024):
+        self.tracker = tracker or TimeTracker()
+        self.size = size
+        self.sessions = collections.OrderedDict()
+
+    def track(self, session_id, value):
+        tracker = self.tracker
+        if isinstance(value, (str, bytes,)):
+            try:
+                value = tracker.loads(value)
+            except tracker.json_errors:
+                value = None
+
+        entry = self.sessions.pop(session_id, None)
+        start = entry[1] if entry and self.is_cached(entry, value) else 0
+        try:
+            value, events = tracker.decode(value, start)
+            if start:
+                session = entry[3]
+                try:
+                    session.extend(events)
+                except ValueError:
+                    # new events precede cached ones
+                    start = 0
+                    value, events = tracker.decode(value)
+            if not start:
+                session = TrackingSession(value['ttl'], tracker)
+                session.extend(events)
+        except InvalidEventError as error:
+            return {'error': str(error)}
+
+        count = len(value['events'])
+        self.sessions[session_id] = (value['ttl'], count,
+                                     value['events'][-1] if count else None,
+                                     session)
+        while len(self.sessions) > self.size:
+            self.sessions.popitem(last=False)
+
+        current_time = value['currentTime']
+        if current_time is None or (session.time is not None and
+                                    current_time < session.time):
+            # session results need current time past events
+            return tracker.track(value)
+        return session.result(current_time)
+
+    def is_cached(self, entry, value):
+        ttl, count, last, session = entry
+        if not (isinstance(value, dict) and
+                isinstance(value.get('events'), list)):
+            return False
+        events = value['events']
+        return (count and value.get('ttl') == ttl and
+                len(events) >= count and events[count - 1] == last)
+
+
+def flatten_device_group(tracker_class, streams, ttl, current_time=None):
+    # executor side of TimeTracker.flatten_device_streams, events of the
+    # streams are returned as their indexes and synthesized ones as is
+    tracker, result = tracker_class(), []
+    for devices in streams:
+        indexes = {id(event): index for index, event in enumerate(devices)}
+        result.append([indexes.get(id(event), event) for event in
+                       tracker.flatten_device_stream(devices, ttl,
+                                                     current_time)])
+    return result
+
+
+def track_lines(lines, min_users=2, ttls=None):
+    # worker side of track_batch, takes and returns JSON lines
+    tracker, result = TimeTracker(min_users), []
+    for line in lines:
+        try:
+            value = tracker.loads(line)
+        except tracker.json_errors:
+            value = None
+        session_id = value.get('id') if isinstance(value, dict) else None
+        try:
+            if ttls is None:
+                data = tracker.track(value)
+            else:
+                data = tracker.sweep_ttl(value, ttls)
+                if isinstance(data, list):
+                    data = {'results': data}
+        except (LookupError, TypeError, ValueError):
+            data = {'error': 'Invalid events value.'}
+        result.append(json.dumps(dict(id=session_id, **data)))
+    return result
+
+
+def track_batch(lines, workers=None, chunk_size=256, ordered=True,
+                min_users=2, ttls=None):
+    # tracks JSON lines with {"id", "events", "ttl", "currentTime"} values
+    # in a process pool, yields JSON result lines in input or completion
+    # order, lines are sent in chunks to amortize IPC, with ttls results
+    # of sweep_ttl are written instead
+    for result in map_chunks(track_lines, lines, workers, chunk_size,
+                             ordered, min_users, ttls):
+        yield from result
+
+
+def aggregate_lines(lines, bucket_size, min_users=2):
+    # worker side of aggregate_batch, takes JSON lines
+    tracker = TimeTracker(min_users)
+    aggregator = BucketAggregator(bucket_size)
+    for line in lines:
+        try:
+            aggregator.add_result(tracker.track_users(line))
+        except (LookupError, TypeError, ValueError):
+            aggregator.errors += 1
+    return aggregator
+
+
+def aggregate_batch(lines, bucket_size, workers=None, chunk_size=256,
+                    min_users=2):
+    # aggregates tracked time per user and bucket of JSON session lines in
+    # a process pool, memory depends on users and buckets count only
+    aggregator = BucketAggregator(bucket_size)
+    for result in map_chunks(aggregate_lines, lines, workers, chunk_size,
+                             False, bucket_size, min_users):
+        aggregator.merge(result)
+    return aggregator
+
+
+def map_chunks(function, lines, workers=None, chunk_size=256, ordered=True,
+               *args):
+    # yields function(chunk, *args) results for chunks of non-empty lines
+    # from a process pool in input or completion order
+    lines = (line for line in lines if line.strip())
+    chunks = iter(lambda: list(itertools.islice(lines, chunk_size)), [])
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        for chunk in chunks:
+            yield function(chunk, *args)
+        return
+
+    import concurrent.futures  # pools only, keeps cli startup short
+    with concurrent.futures.ProcessPoolExecutor(workers) as executor:
+        def submit(chunk):
+            return executor.submit(function, chunk, *args)
+
+        # bound chunks in flight to keep memory flat on huge inputs
+        futures = collections.deque(
+            map(submit, itertools.islice(chunks, 2 * workers)))
+        while futures:
+            if ordered:
+                done = [futures.popleft()]
+            else:
+                done, _ = concurrent.futures.wait(
+                    futures, return_when=concurrent.futures.FIRST_COMPLETED)
+                futures = collections.deque(i for i in futures
+                                            if i not in done)
+            for future in done:
+                yield future.result()
+            futures.extend(map(submit, itertools.islice(chunks, len(done))))
+
+
+@functools.lru_cache()
+def get_tracker(min_users=2):
+    # warm tracker kept per server process
+    return TimeTracker(min_users)
+
+
+def track_request(line, min_users=2):
+    try:
+        data = get_tracker(min_users).track(line)
+    except (LookupError, TypeError, ValueError):
+        data = {'error': 'Invalid events value.'}
+    return json.dumps(data).encode() + b'\n'
+
+
+async def start_server(address, workers=None, max_pending=64,
+                       max_size=2 ** 28, min_users=2):
+    # newline delimited JSON: one track value per line, one result line
+    # back, reads and requests in progress are bounded by max_pending,
+    # connections above the bound are paused, so their request lines are
+    # not read until others are answered, lines longer than max_size get
+    # an error line back, the worker pool is shut down with the server
+    import asyncio  # server only, keeps cli startup short
+    import concurrent.futures
+    from kbtt_client import parse_address
+
+    loop = asyncio.get_running_loop()
+    executor = (concurrent.futures.ProcessPoolExecutor(workers)
+                if workers and workers > 1 else None)
+    pending = asyncio.Semaphore(max_pending)
+
+    async def handle(reader, writer):
+        transport = writer.transport
+        transport.pause_reading()
+        try:
+            while True:
+                async with pending:
+                    transport.resume_reading()
+                    try:
+                        line = await reader.readline()
+                    except ValueError:
+                        await reject(reader, writer)
+                        break
+                    transport.pause_reading()
+                    if not line:
+                        break
+                    if not line.strip():
+                        continue
+                    result = await loop.run_in_executor(
+                        executor, track_request, line, min_users)
+                writer.write(result)
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    async def reject(reader, writer):
+        # the rest of the line is dropped as it arrives, so clients still
+        # sending it get the error instead of a reset
+        writer.write(json.dumps(
+            {'error': 'Request line is too long.'}).encode() + b'\n')
+        await writer.drain()
+        while True:
+            chunk = await reader.read(2 ** 16)
+            if not chunk or b'\n' in chunk:
+                break
+
+    async def shutdown(server):
+        try:
+            await server.wait_closed()
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+    path, port = parse_address(address)
+    if port is None:
+        server = await asyncio.start_unix_server(handle, path,
+                                                 limit=max_size)
+    else:
+        server = await asyncio.start_server(handle, path, port,
+                                            limit=max_size)
+    # kept on the server, the loop holds tasks weakly
+    server.shutdown_executor = loop.create_task(shutdown(server))
+    return server
+
+
+async def serve(address, **options):
+    # serve forever, for example asyncio.run(serve('unix:/tmp/kbtt.sock'))
+    server = await start_server(address, **options)
+    async with server:
+        await server.serve_forever()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if not argv:
+        # plain track call, skips building the parser and its imports
+        if sys.stdin.isatty():
+            data = {'error': 'Input stream is unavailable.'}
+        else:
+            data = TimeTracker().track(sys.stdin.buffer.read())
+        sys.stdout.write(json.dumps(data))
+        return
+
+    import argparse  # options only
+
+    parser = argparse.ArgumentParser(description='KB time tracker.')
+    parser.add_argument('--min-users', type=int, default=2,
+                        help='distinct connected users required to track '
+                             'time, 2 by default')
+    parser.add_argument('--profile', action='store_true',
+                        help='write stage timings of the track call to '
+                             'stderr')
+    parser.add_argument('--intervals', action='store_true',
+                        help='add tracked [start, end] intervals to the '
+                             'result')
+    parser.add_argument('--log', metavar='PATH',
+                        help='track a binary event log instead of stdin')
+    parser.add_argument('--write-log', metavar='PATH',
+                        help='convert input JSON to a binary event log')
+    parser.add_argument('--compact', action='store_true',
+                        help='drop events that can not change the result '
+                             'and write the input JSON, the --write-log log '
+                             'or the --log log in place')
+    parser.add_argument('--ndjson', action='store_true',
+                        help='read a {"ttl", "currentTime"} header line and '
+                             'then one event per line in time order')
+    parser.add_argument('--lateness', type=float, default=None,
+                        help='ndjson mode reorders events up to the lateness '
+                             'and counts later ones')
+    parser.add_argument('--batch', action='store_true',
+                        help='read one {"id", "events", "ttl", '
+                             '"currentTime"} value per line and write one '
+                             'result per line')
+    parser.add_argument('--buckets', type=float, metavar='SIZE',
+                        help='batch mode writes tracked time per user and '
+                             'time bucket of the size instead')
+    parser.add_argument('--ttl-sweep', type=float, nargs='+', metavar='TTL',
+                        help='write results for each of the ttl values, in '
+                             'batch mode too')
+    parser.add_argument('--serve', metavar='ADDRESS',
+                        help='run a tracker server on unix:/path or '
+                             'host:port')
+    parser.add_argument('--max-pending', type=int, default=64,
+                        help='server requests in progress')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='batch mode or server worker processes, cpu '
+                             'count by default in batch mode, device '
+                             'flattening processes of large sessions '
+                             'otherwise')
+    parser.add_argument('--chunk-size', type=int, default=256,
+                        help='batch mode lines per worker task')
+    parser.add_argument('--unordered', action='store_true',
+                        help='batch mode writes results in completion order')
+    args = parser.parse_args(argv)
+
+    if args.serve:
+        import asyncio
+        asyncio.run(serve(args.serve, workers=args.workers,
+                          max_pending=args.max_pending,
+                          min_users=args.min_users))
+        return
+
+    if args.log:
+        try:
+            with EventLog(args.log) as log:
+                tracker = TimeTracker(args.min_users)
+                if args.compact:
+                    data = tracker.compact_log(log,
+                                               args.write_log or args.log)
+                else:
+                    data = tracker.track_log(log, args.intervals)
+        except (OSError, ValueError):
+            data = {'error': 'Invalid event log.'}
+    elif sys.stdin.isatty():
+        data = {'error': 'Input stream is unavailable.'}
+    elif args.write_log:
+        data = TimeTracker(args.min_users).convert_log(
+            sys.stdin.buffer.read(), args.write_log, args.compact)
+    elif args.compact:
+        data = TimeTracker(args.min_users).compact(sys.stdin.buffer.read())
+    elif args.batch and args.buckets:
+        aggregator = aggregate_batch(sys.stdin, args.buckets, args.workers,
+                                     args.chunk_size, args.min_users)
+        for row in aggregator.rows():
+            sys.stdout.write(json.dumps(row) + '\n')
+        if aggregator.errors:
+            sys.stderr.write(json.dumps({'sessions': aggregator.sessions,
+                                         'errors': aggregator.errors}) + '\n')
+        return
+    elif args.batch:
+        for line in track_batch(sys.stdin, args.workers, args.chunk_size,
+                                not args.unordered, args.min_users,
+                                args.ttl_sweep):
+            sys.stdout.write(line + '\n')
+        return
+    elif args.ndjson:
+        data = TimeTracker(args.min_users).track_ndjson(
+            sys.stdin, lateness=args.lateness)
+    elif args.ttl_sweep:
+        data = TimeTracker(args.min_users).sweep_ttl(sys.stdin.buffer.read(),
+                                                     args.ttl_sweep)
+        if isinstance(data, list):
+            data = {'results': data}
+    else:
+        profile, executor = Profile(), None
+        if args.workers:
+            import concurrent.futures
+            executor = concurrent.futures.ProcessPoolExecutor(args.workers)
+        tracker = TimeTracker(args.min_users,
+                              hooks=[profile] if args.profile else [],
+                              executor=executor)
+        started = time.perf_counter()
+        value = sys.stdin.buffer.read()
+        if args.profile:
+            tracker.notify('read', started, None, None, size=len(value))
+        data = tracker.track(value, args.intervals)
+        if executor:
+            executor.shutdown()
+        if args.profile:
+            sys.stderr.write(json.dumps(profile.stages) + '\n')
+    sys.stdout.write(json.dumps(data))
+
@@ -1,5 +1,34 @@
 import unittest
-from kbtt import AppState, TimeTracker
+import os
+import sys
+import json
+import random
+import asyncio
+import tempfile
+import multiprocessing
+import subprocess
+import importlib.util
+import concurrent.futures
+import kbtt
+import bench
+import fuzz
+import kbtt_client
+from kbtt import (AppState, TimeTracker, TrackingSession, track_batch,
+                  ColumnarTimeTracker, SnapshotStore,)
+
+
+def random_events(rng, size=30):
+    # unordered logs of up to size events over 2 users and 3 devices
+    events = []
+    for i in range(rng.randint(0, size)):
+        if rng.random() < 0.2:
+            events.append({'t': rng.choice('spue'), 'c': rng.randint(0, 40)})
+        else:
+            events.append({'t': rng.choice('cd'),
+                           'c': rng.randint(0, 40),
+                           'u': rng.randint(1, 2),
+                           'd': rng.choice('123')})
+    return events
 
 
 class TrackTest(unittest.TestCase):
@@ -20,6 +49,517 @@ class TrackTest(unittest.TestCase):
             '{"events": [{"t": "s", "c": 0}], "ttl": 4, "currentTime": 10}'
         ))
 
+    def test_track_validation(self):
+        value = {'events': [], 'ttl': 4, 'currentTime': 10}
+        self.assertTrue('error' in self.tt.track(dict(value, ttl='4')))
+        self.assertTrue('error' in self.tt.track(dict(value, ttl=None)))
+        self.assertTrue('error' in self.tt.track(dict(value, events={})))
+        self.assertFalse('error' in self.tt.track(dict(value,
+                                                       currentTime=None)))
+
+        # should reject malformed events up front
+        for event in ({'t': 's'}, {'t': 'x', 'c': 0}, {'t': 's', 'c': '0'},
+                      {'t': 'c', 'c': 0, 'u': 1}, {'t': 'd', 'c': 0, 'd': 1},
+                      {'t': 'c', 'c': 0, 'u': [1], 'd': '1'}, ['s', 0]):
+            self.assertEqual(self.tt.track(dict(value, events=[
+                {'t': 's', 'c': 0}, event,
+            ])), {'error': 'Invalid event at index 1.'})
+        self.assertEqual(self.tt.track_ndjson([
+            '{"ttl": 4, "currentTime": 10}', '{"t": "s", "c": 0}',
+            '{"t": "c", "c": 1, "d": "1"}',
+        ]), {'error': 'Invalid event at index 1.'})
+
+    def test_track_json_backends(self):
+        with open('input.json', 'rb') as file:
+            value = file.read()
+        for backend in kbtt.JSON_BACKENDS:
+            try:
+                tt = TimeTracker(json_backend=backend)
+            except ImportError:
+                continue
+            self.assertEqual(tt.track(value), self.tt.track(value.decode()))
+            self.assertTrue('error' in tt.track(b'Invalid json'))
+            self.assertTrue('error' in tt.track(b'\xff'))
+        with self.assertRaises(ValueError):
+            TimeTracker(json_backend='unknown')
+
+        # should import only the picked backend, the default one only for
+        # large payloads
+        for code in ('kbtt.TimeTracker(json_backend="json")',
+                     'kbtt.TimeTracker().track(sys.stdin.read())'):
+            output = subprocess.run(
+                [sys.executable, '-c', 'import sys, kbtt; %s; '
+                 'print(sorted({"orjson", "msgspec"} & set(sys.modules)))'
+                 % code], input=value.decode(), capture_output=True,
+                text=True, check=True).stdout
+            self.assertEqual(output, '[]\n')
+
+        class SmallTimeTracker(TimeTracker):
+            fast_json_size = 16
+
+        tt = SmallTimeTracker()
+        self.assertEqual(tt.track(value), self.tt.track(value.decode()))
+        self.assertEqual(tt.loads, kbtt.import_json_backend()[0])
+        self.assertTrue('error' in tt.track(b'Invalid json, not small'))
+        self.assertTrue('error' in tt.track(b'\xff' * 16))
+
+    def test_cli(self):
+        with open('input.json') as file:
+            value = file.read()
+        for args, expected in (([], self.tt.track(value)),
+                               (['--intervals'], self.tt.track(value, True))):
+            output = subprocess.run(
+                [sys.executable, '-X', 'importtime', 'kbtt.py'] + args,
+                input=value, capture_output=True, text=True, check=True)
+            self.assertEqual(json.loads(output.stdout), expected)
+            # should answer plain calls without the option parser
+            self.assertEqual(' argparse\n' in output.stderr, bool(args))
+
+    def test_event_records(self):
+        class RecordTimeTracker(TimeTracker):
+            record = kbtt.Event
+
+        with open('input.json') as file:
+            value = json.load(file)
+        self.assertEqual(RecordTimeTracker().track(value),
+                         self.tt.track(value))
+        self.assertEqual(
+            RecordTimeTracker().decode_events(value['events'])[:3],
+            value['events'][:3])
+        self.assertEqual(kbtt.Event('c', 1, 2, '3')['d'], '3')
+        self.assertEqual(kbtt.Event('s', 1).get('d', 1), None)
+
+    def test_track_ndjson(self):
+        self.assertTrue('error' in self.tt.track_ndjson([]))
+        self.assertTrue('error' in self.tt.track_ndjson(['Invalid json']))
+        self.assertTrue('error' in self.tt.track_ndjson(['{"ttl": 4}']))
+        self.assertTrue('error' in self.tt.track_ndjson([
+            '{"ttl": 4, "currentTime": 10}', '{"t": "s", "c": 0',
+        ]))
+        self.assertEqual(self.tt.track_ndjson([
+            '{"ttl": 4, "currentTime": 10}', '{"t": "s", "c": 1}',
+            '{"t": "p", "c": 0}',
+        ], chunk_size=1), {'error': 'Events should be ordered by time.'})
+
+        # should reject null currentTime and one preceding events
+        self.assertEqual(self.tt.track_ndjson([
+            '{"ttl": 4, "currentTime": null}', '{"t": "s", "c": 1}',
+        ]), {'error': 'Invalid currentTime value. Number is required.'})
+        self.assertEqual(self.tt.track_ndjson([
+            '{"ttl": 4, "currentTime": 0}', '{"t": "s", "c": 1}',
+        ]), {'error': 'Current time precedes events.'})
+
+        # should match track with events split into chunks
+        lines = [
+            '{"ttl": 4, "currentTime": 10}',
+            '{"t": "s", "c": 0}',
+            '{"t": "p", "c": 1}',
+            '',
+            '{"t": "c", "c": 2, "u": 1, "d": "1"}',
+            '{"t": "c", "c": 3, "u": 2, "d": "2"}',
+            '{"t": "c", "c": 6, "u": 1, "d": "1"}',
+            '{"t": "u", "c": 7}',
+        ]
+        self.assertEqual(
+            self.tt.track_ndjson(lines, chunk_size=2),
+            self.tt.track('{"events": [%s], "ttl": 4, "currentTime": 10}' %
+                          ', '.join(filter(None, lines[1:]))))
+
+        # should reorder events up to lateness and count later ones
+        unordered = lines[:2] + lines[4:6] + lines[2:4] + lines[6:]
+        self.assertTrue('error' in self.tt.track_ndjson(unordered,
+                                                        chunk_size=1))
+        self.assertEqual(
+            self.tt.track_ndjson(unordered, chunk_size=1, lateness=2),
+            dict(self.tt.track_ndjson(lines), lateEvents=0))
+        self.assertEqual(
+            self.tt.track_ndjson(unordered, chunk_size=1, lateness=1),
+            dict(self.tt.track_ndjson(lines[:2] + lines[4:]), lateEvents=1))
+
+        # should stop reading lines after the chunk the session ended in
+        ended = lines + ['{"t": "e", "c": 8}', '{"t": "c", "c": 9, "d": 1}']
+        read = []
+        self.assertEqual(
+            self.tt.track_ndjson((read.append(i) or i for i in ended),
+                                 chunk_size=1),
+            self.tt.track_ndjson(ended[:-1]))
+        self.assertEqual(read, ended[:-1])
+        late = ended[:-1] + ['{"t": "c", "c": 10, "u": 1, "d": "1"}',
+                             '{"t": "c", "c": 1, "d": 1}']
+        self.assertEqual(
+            self.tt.track_ndjson(late, chunk_size=1, lateness=1),
+            dict(self.tt.track_ndjson(ended[:-1]), lateEvents=0))
+        self.assertTrue('error' in self.tt.track_ndjson(ended))
+
+    def test_track_hooks(self):
+        profile = kbtt.Profile()
+        tt = TimeTracker(hooks=[profile])
+        tt.track(json.dumps({
+            'events': [
+                {'t': 's', 'c': 0,},
+                {'t': 'p', 'c': 1,},
+                {'t': 'c', 'c': 2, 'u': 1, 'd': '1',},
+                {'t': 'c', 'c': 3, 'u': 2, 'd': '2',},
+                {'t': 'c', 'c': 6, 'u': 1, 'd': '1',},
+                {'t': 'u', 'c': 7,},
+                {'t': 'p', 'c': 8,},
+            ],
+            'ttl': 4,
+            'currentTime': 10,
+        }))
+
+        # should report every stage with events counts
+        self.assertEqual([(i['stage'], i['events_in'], i['events_out'])
+                          for i in profile.stages], [
+            ('decode', None, 7),
+            ('sort', 7, 7),
+            ('find_device_streams', 7, 7),
+            ('flatten_device_stream', 3, 6),
+            ('merge_event_streams', 10, 10),
+            ('reduce_events', 10, None),
+        ])
+        self.assertEqual(profile.stages[3]['synthesized'], 3)
+        self.assertEqual(profile.stages[3]['devices'], 2)
+        self.assertTrue(all(i['time'] >= 0 for i in profile.stages))
+
+        # should call added hooks too
+        stages = []
+        tt.add_hook(lambda stage, stats: stages.append(stage))
+        tt.track({'events': [], 'ttl': 4, 'currentTime': 10})
+        self.assertEqual(stages, [i['stage'] for i in profile.stages[:6]])
+
+    def test_track_intervals(self):
+        value = {
+            'events': [
+                {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+                {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+                {'t': 'p', 'c': 3,},
+                {'t': 'u', 'c': 5,},
+                {'t': 'd', 'c': 6, 'u': 2, 'd': '2',},
+                {'t': 'c', 'c': 7, 'u': 2, 'd': '2',},
+                {'t': 'e', 'c': 9,},
+            ],
+            'ttl': 100,
+            'currentTime': 20,
+        }
+        result = self.tt.track(value, intervals=True)
+        self.assertEqual(result['intervals'], [[1, 3], [5, 6], [7, 9]])
+        self.assertNotIn('intervals', self.tt.track(value))
+
+        # should sum tracked time of any range
+        index = kbtt.IntervalIndex(result['intervals'])
+        self.assertEqual(index.tracked_time(), result['trackedTime'])
+        self.assertEqual(index.tracked_time(2, 8), 3)
+        self.assertEqual(index.tracked_time(end=5.5), 2.5)
+        self.assertEqual(index.tracked_time(10, 30), 0)
+        self.assertEqual(kbtt.IntervalIndex([]).tracked_time(0, 1), 0)
+
+    def test_sweep_ttl(self):
+        value = bench.generate_events(300, devices=3, jitter=0.7, seed=1)
+        ttls = [0, 2.5, 10, 30, 45, 100]
+
+        # should match track for each ttl
+        self.assertEqual(self.tt.sweep_ttl(value, ttls), [
+            dict(ttl=ttl, **self.tt.track(dict(value, ttl=ttl)))
+            for ttl in ttls
+        ])
+        self.assertEqual(self.tt.sweep_ttl(value, []), [])
+        self.assertTrue('error' in self.tt.sweep_ttl(value, ['30']))
+        self.assertTrue('error' in self.tt.sweep_ttl(None, ttls))
+
+
+class TrackBatchTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.values = [{
+            'id': str(i),
+            'events': [
+                {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+                {'t': 'c', 'c': i % 3, 'u': 2, 'd': '2',},
+                {'t': 'p', 'c': i % 5,},
+            ],
+            'ttl': 4,
+            'currentTime': i % 7,
+        } for i in range(50)]
+        self.lines = [json.dumps(i) for i in self.values] + ['', 'Invalid']
+
+    def test_track_batch(self):
+        expected = [dict(id=i['id'], **self.tt.track(i)) for i in self.values]
+        expected.append({'id': None, 'error': self.tt.track(None)['error']})
+
+        # should keep input order
+        for workers in (1, 2):
+            self.assertEqual([json.loads(i) for i in track_batch(
+                self.lines, workers=workers, chunk_size=4)], expected)
+
+        # should return all results in completion order
+        self.assertEqual(sorted(track_batch(self.lines, workers=2,
+                                            chunk_size=4, ordered=False)),
+                         sorted(json.dumps(i) for i in expected))
+
+        # should report invalid events
+        self.assertEqual(list(track_batch(['{"id": 1, "events": [{}], '
+                                           '"ttl": 4, "currentTime": 1}'],
+                                          workers=1)),
+                         ['{"id": 1, "error": "Invalid event at index 0."}'])
+
+    def test_track_batch_ttls(self):
+        # should write sweep_ttl results
+        self.assertEqual([json.loads(i) for i in track_batch(
+            self.lines[:-2], workers=1, ttls=[1, 4])], [
+            {'id': i['id'], 'results': self.tt.sweep_ttl(i, [1, 4])}
+            for i in self.values
+        ])
+
+
+class BucketAggregatorTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+
+    def test_track_users(self):
+        # should credit tracked time to users while they are connected
+        result = TimeTracker(1).track_users({
+            'events': [
+                {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+                {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+                {'t': 'd', 'c': 3, 'u': 1, 'd': '1',},
+                {'t': 'p', 'c': 4,},
+                {'t': 'u', 'c': 5,},
+                {'t': 'e', 'c': 6,},
+            ],
+            'ttl': 100,
+            'currentTime': 10,
+        })
+        self.assertEqual(result['trackedTime'], 5)
+        self.assertEqual(result['users'], [[1, [[0, 3]]],
+                                           [2, [[1, 4], [5, 6]]]])
+        self.assertTrue('error' in self.tt.track_users('{}'))
+
+    def test_add(self):
+        # should split intervals at bucket boundaries
+        aggregator = kbtt.BucketAggregator(10)
+        aggregator.add(1, [[5, 25], [28, 29]])
+        aggregator.add(2, [[-5, 5]])
+        self.assertEqual(aggregator.rows(), [
+            {'user': 1, 'bucket': 0, 'trackedTime': 5},
+            {'user': 1, 'bucket': 10, 'trackedTime': 10},
+            {'user': 1, 'bucket': 20, 'trackedTime': 6},
+            {'user': 2, 'bucket': -10, 'trackedTime': 5},
+            {'user': 2, 'bucket': 0, 'trackedTime': 5},
+        ])
+
+        # should sum totals of merged aggregators
+        other = kbtt.BucketAggregator(10)
+        other.add(2, [[0, 1]])
+        other.errors = 1
+        aggregator.merge(other)
+        self.assertEqual(aggregator.totals[(2, 0)], 6)
+        self.assertEqual(aggregator.errors, 1)
+        with self.assertRaises(ValueError):
+            kbtt.BucketAggregator(0)
+
+    def test_aggregate_batch(self):
+        lines = [json.dumps(bench.generate_events(200, devices=3, seed=i))
+                 for i in range(20)] + ['Invalid']
+        expected = kbtt.BucketAggregator(30)
+        for line in lines:
+            expected.add_result(self.tt.track_users(line))
+
+        # should match sequential aggregation in any worker count
+        for workers in (1, 2):
+            aggregator = kbtt.aggregate_batch(lines, 30, workers=workers,
+                                              chunk_size=3)
+            self.assertEqual(aggregator.sessions, 20)
+            self.assertEqual(aggregator.errors, 1)
+            self.assertEqual(aggregator.totals.keys(),
+                             expected.totals.keys())
+            for key, value in expected.totals.items():
+                self.assertAlmostEqual(aggregator.totals[key], value)
+
+
+class ServerTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.directory = tempfile.TemporaryDirectory()
+        self.address = 'unix:' + os.path.join(self.directory.name, 'sock')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def request(self, values, **options):
+        # clients get their own threads, the default executor tracks
+        clients = concurrent.futures.ThreadPoolExecutor(len(values))
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            server = await kbtt.start_server(self.address, **options)
+            async with server:
+                return await asyncio.gather(*(
+                    loop.run_in_executor(clients, kbtt_client.request,
+                                         self.address, value)
+                    for value in values))
+
+        with clients:
+            return [json.loads(i) for i in asyncio.run(run())]
+
+    def test_server(self):
+        with open('input.json') as file:
+            value = file.read()
+        values = [value, 'Invalid json', '{}'] + [
+            json.dumps({'events': [
+                {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+                {'t': 'c', 'c': i, 'u': 2, 'd': '2',},
+            ], 'ttl': 4, 'currentTime': 10}) for i in range(8)
+        ]
+
+        # should answer concurrent requests as track does
+        expected = [self.tt.track(i) for i in values]
+        self.assertEqual(self.request(values), expected)
+        self.assertEqual(self.request(values, max_pending=1), expected)
+
+    def test_large_request(self):
+        # should answer lines longer than max_size with an error line
+        value = json.dumps({'events': [{'t': 'p', 'c': i}
+                                       for i in range(1000)],
+                            'ttl': 4, 'currentTime': 1000})
+        self.assertEqual(self.request([value, '{}'], max_size=1024),
+                         [{'error': 'Request line is too long.'},
+                          self.tt.track('{}')])
+
+    def test_workers(self):
+        # should shut worker processes down with the server
+        with open('input.json') as file:
+            value = file.read()
+        self.assertEqual(self.request([value], workers=2),
+                         [self.tt.track(value)])
+        self.assertEqual(multiprocessing.active_children(), [])
+
+    def test_parse_address(self):
+        self.assertEqual(kbtt_client.parse_address('unix:/tmp/kbtt.sock'),
+                         ('/tmp/kbtt.sock', None))
+        self.assertEqual(kbtt_client.parse_address('127.0.0.1:8000'),
+                         ('127.0.0.1', 8000))
+        self.assertEqual(kbtt_client.parse_address(':8000'),
+                         ('localhost', 8000))
+
+
+class EventLogTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'events.kbtl')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def test_track_log(self):
+        # should track logs of int, float and mixed times as the input
+        for times in ([0, 1, 2, 3, 6, 7], [0.5, 1, 2.5, 3, 6, 7.5],
+                      [0.5, 1.5, 2.5, 3.5, 6.5, 7.5]):
+            value = {
+                'events': [
+                    {'t': 's', 'c': times[0],},
+                    {'t': 'p', 'c': times[1],},
+                    {'t': 'c', 'c': times[2], 'u': 1, 'd': '1',},
+                    {'t': 'c', 'c': times[3], 'u': 'x', 'd': 2,},
+                    {'t': 'c', 'c': times[4], 'u': 1, 'd': '1',},
+                    {'t': 'u', 'c': times[5],},
+                ],
+                'ttl': 4,
+                'currentTime': 10,
+            }
+            self.assertEqual(self.tt.convert_log(value, self.path),
+                             {'events': 6})
+            with kbtt.EventLog(self.path) as log:
+                self.assertEqual(len(log), 6)
+                self.assertEqual(log.events(), value['events'])
+                self.assertEqual(log.events(kbtt.Event), value['events'])
+                self.assertEqual(
+                    json.dumps(self.tt.track_log(log, intervals=True)),
+                    json.dumps(self.tt.track(value, intervals=True)))
+
+    def test_invalid_log(self):
+        self.assertEqual(self.tt.convert_log('{}', self.path), {
+            'error': 'Invalid input value. JSON or dict are allowed.',
+        })
+        for data in (b'', b'KBTL', b'{"events": []}' * 4):
+            with open(self.path, 'wb') as file:
+                file.write(data)
+            with self.assertRaises(ValueError):
+                kbtt.EventLog(self.path)
+
+
+class CompactEventsTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+
+    def test_compact_events(self):
+        events = [
+            {'t': 's', 'c': 0,},
+            {'t': 's', 'c': 0,},
+            {'t': 'c', 'c': 1, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 1, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 2, 'u': 2, 'd': '2',},
+            {'t': 'c', 'c': 4, 'u': 1, 'd': '1',},
+            {'t': 'p', 'c': 5,},
+            {'t': 'p', 'c': 6,},
+            {'t': 'c', 'c': 7, 'u': 1, 'd': '1',},
+            {'t': 'u', 'c': 8,},
+            {'t': 'c', 'c': 9, 'u': 1, 'd': '1',},
+            {'t': 'd', 'c': 10, 'u': 2, 'd': '2',},
+            {'t': 'd', 'c': 11, 'u': 2, 'd': '2',},
+            {'t': 'e', 'c': 12,},
+            {'t': 'c', 'c': 13, 'u': 2, 'd': '2',},
+        ]
+        # should drop duplicates, repeated pauses and disconnects, events
+        # after the end and connects followed within ttl of the kept one
+        self.assertEqual(self.tt.compact_events(events, 10), [
+            events[0], events[2], events[4], events[6], events[9], events[10],
+            events[11], events[13],
+        ])
+        # should keep connects the next event doesn't follow within ttl of
+        # the kept one and all connects with ttl of 0
+        self.assertEqual(len(self.tt.compact_events(events, 5)), 10)
+        self.assertEqual(len(self.tt.compact_events(events, 0)), 11)
+
+        # should keep the track result
+        for ttl in (1, 2.5, 5, 10):
+            value = {'events': events, 'ttl': ttl, 'currentTime': 20}
+            self.assertEqual(self.tt.track(self.tt.compact(value)),
+                             self.tt.track(value))
+
+    def test_compact_random(self):
+        for seed in range(20):
+            value = bench.generate_events(300, devices=3, jitter=0.3 + seed %
+                                          3 * 0.2, disorder=0.1, seed=seed)
+            events = value['events']
+            events.extend(dict(i) for i in events[::10])
+            expected = self.tt.track(value)
+            for tracker in (self.tt, kbtt.TableTimeTracker(),
+                            kbtt.CompactTimeTracker()):
+                compacted = tracker.compact(json.dumps(value))
+                self.assertLess(len(compacted['events']), len(events))
+                self.assertEqual(self.tt.track(compacted), expected)
+        self.assertTrue('error' in self.tt.compact('{}'))
+
+    def test_compact_log(self):
+        value = bench.generate_events(500, jitter=0.2)
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.kbtl')
+            self.tt.convert_log(value, path)
+
+            # should rewrite the log in place
+            with kbtt.EventLog(path) as log:
+                result = self.tt.compact_log(log, path)
+            self.assertEqual(result['events'] + result['droppedEvents'], 500)
+            with kbtt.EventLog(path) as log:
+                self.assertEqual(len(log), result['events'])
+                self.assertEqual(self.tt.track_log(log),
+                                 self.tt.track(value))
+
+            self.assertEqual(self.tt.convert_log(value, path, compact=True),
+                             result)
+
 
 class ReduceEventsTest(unittest.TestCase):
     def setUp(self):
@@ -102,6 +642,37 @@ class ReduceEventsTest(unittest.TestCase):
             {'t': 'd', 'c': 100, 'u': 2, 'd': '2',},
         ])['trackedTime'], 100)
 
+    def test_reduce_min_users(self):
+        events = [
+            {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+            {'t': 'c', 'c': 2, 'u': 2, 'd': '3',},
+            {'t': 'c', 'c': 3, 'u': 3, 'd': '4',},
+            {'t': 'd', 'c': 4, 'u': 2, 'd': '2',},
+            {'t': 'c', 'c': 5, 'u': 3, 'd': '2',},
+            {'t': 'd', 'c': 6, 'u': 2, 'd': '3',},
+            {'t': 'd', 'c': 7, 'u': 1, 'd': '1',},
+            {'t': 'e', 'c': 9,},
+        ]
+
+        # should track only with enough distinct users connected
+        self.assertEqual(TimeTracker(1).reduce_events(events)['trackedTime'],
+                         9)
+        self.assertEqual(self.tt.reduce_events(events)['trackedTime'], 6)
+        self.assertEqual(TimeTracker(3).reduce_events(events)['trackedTime'],
+                         3)
+        self.assertEqual(TimeTracker(4).reduce_events(events)['trackedTime'],
+                         0)
+
+        # should count user of reconnected device once
+        self.assertEqual(TimeTracker(3).reduce_events(events[:4] + [
+            {'t': 'c', 'c': 4, 'u': 1, 'd': '4',},
+            {'t': 'c', 'c': 5, 'u': 3, 'd': '1',},
+        ])['state'], AppState.IN_PROGRESS)
+        self.assertEqual(TimeTracker(3).reduce_events(events[:4] + [
+            {'t': 'c', 'c': 4, 'u': 1, 'd': '4',},
+        ])['state'], AppState.IDLE)
+
     def test_last_active(self):
         # should be null with one user
         self.assertEqual(self.tt.reduce_events([
@@ -374,6 +945,463 @@ class FlattenTest(unittest.TestCase):
             {'t': 'e', 'c': 3,},
         ])
 
+    def test_merge_event_streams(self):
+        # should merge sorted streams keeping ties in streams order
+        self.assertEqual(self.tt.merge_event_streams([
+            [{'t': 's', 'c': 0,}, {'t': 'e', 'c': 3,},],
+            [],
+            [{'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+             {'t': 'd', 'c': 3, 'u': 1, 'd': '1',},],
+            [{'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+             {'t': 'd', 'c': 3, 'u': 2, 'd': '2',},],
+        ]), [
+            {'t': 's', 'c': 0,},
+            {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+            {'t': 'e', 'c': 3,},
+            {'t': 'd', 'c': 3, 'u': 1, 'd': '1',},
+            {'t': 'd', 'c': 3, 'u': 2, 'd': '2',},
+        ])
+        self.assertEqual(self.tt.merge_event_streams([[], []]), [])
+
+    def test_flatten_device_streams(self):
+        value = bench.generate_events(2000, devices=40, jitter=0.6, seed=1)
+        events = value['events']
+        streams = list(self.tt.find_device_streams(events)[0].values())
+        expected = [self.tt.flatten_device_stream(i, 30) for i in streams]
+        real = set(map(id, events))
+
+        # should flatten device groups in executor tasks above thresholds
+        # and keep the events of the streams
+        with concurrent.futures.ThreadPoolExecutor(2) as threads, \
+                concurrent.futures.ProcessPoolExecutor(1) as processes:
+            for executor in (threads, processes):
+                tt = TimeTracker(executor=executor)
+                self.assertEqual(tt.flatten_device_streams(streams, 30),
+                                 expected)
+                tt.parallel_devices = 10
+                tt.parallel_events = 1000
+                tt.group_events = 300
+                flattened = tt.flatten_device_streams(streams, 30)
+                self.assertEqual(flattened, expected)
+                self.assertEqual(
+                    [id(i) for stream in flattened for i in stream
+                     if id(i) in real],
+                    [id(i) for stream in expected for i in stream
+                     if id(i) in real])
+
+                tracker = kbtt.CompactTimeTracker(executor=executor)
+                tracker.parallel_devices = 10
+                tracker.parallel_events = 1000
+                self.assertEqual(tracker.track(json.dumps(value), True),
+                                 self.tt.track(value, True))
+
+
+class TrackingSessionTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.events = [
+            {'t': 's', 'c': 0,},
+            {'t': 'p', 'c': 1,},
+            {'t': 'c', 'c': 2, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 3, 'u': 2, 'd': '2',},
+            {'t': 'c', 'c': 6, 'u': 1, 'd': '1',},
+            {'t': 'u', 'c': 7,},
+            {'t': 'c', 'c': 8, 'u': 2, 'd': '2',},
+            {'t': 'c', 'c': 9, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 11, 'u': 2, 'd': '2',},
+            {'t': 'p', 'c': 12,},
+            {'t': 'u', 'c': 13,},
+            {'t': 'd', 'c': 14, 'u': 1, 'd': '1',},
+            {'t': 'e', 'c': 15,},
+            {'t': 'c', 'c': 16, 'u': 1, 'd': '1',},
+        ]
+
+    def test_append(self):
+        # should match track on every prefix of the log
+        for size in (1, 2, 3, 5):
+            session = TrackingSession(4)
+            for i in range(0, len(self.events), size):
+                chunk = self.events[i:i + size]
+                current_time = chunk[-1]['c'] + 2
+                self.assertEqual(
+                    session.append(chunk, current_time),
+                    self.tt.track({'events': self.events[:i + size],
+                                   'ttl': 4, 'currentTime': current_time}))
+
+    def test_append_unordered_chunk(self):
+        # should sort each appended chunk
+        session = TrackingSession(4)
+        session.append(self.events[:4], 3)
+        self.assertEqual(
+            session.append(self.events[4:][::-1], 20),
+            self.tt.track({'events': self.events, 'ttl': 4,
+                           'currentTime': 20}))
+
+    def test_result(self):
+        # should expire devices only on result with later current time
+        session = TrackingSession(4)
+        session.extend([
+            {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+        ])
+        self.assertEqual(session.result(3)['state'], AppState.IN_PROGRESS)
+        self.assertEqual(session.result(10), {
+            'trackedTime': 1,
+            'lastActive': 1,
+            'stateTime': 3,
+            'state': AppState.IDLE,
+        })
+        self.assertEqual(session.result(3)['state'], AppState.IN_PROGRESS)
+
+    def test_late_events(self):
+        # should reject events and current time preceding appended events
+        session = TrackingSession(4)
+        session.append(self.events[:5], 6)
+        with self.assertRaises(ValueError):
+            session.extend(self.events[2:3])
+        with self.assertRaises(ValueError):
+            session.result(5)
+
+    def test_reorder_buffer(self):
+        # should release events in time order behind the watermark
+        session = TrackingSession(4)
+        buffer = kbtt.ReorderBuffer(session, 2)
+        events = (self.events[:2] + self.events[3:4] + self.events[2:3] +
+                  self.events[4:5])
+        self.assertEqual(buffer.push(events), [])
+        self.assertEqual(buffer.watermark, 4)
+        self.assertEqual(session.time, 3)
+        self.assertEqual(len(buffer.pending), 1)
+
+        # should return events behind the watermark as late
+        self.assertEqual(buffer.push(self.events[5:8] + self.events[1:2]),
+                         self.events[1:2])
+        self.assertEqual(buffer.late, 1)
+        self.assertEqual(len(buffer.pending), 2)
+        buffer.flush()
+        self.assertEqual(buffer.pending, [])
+        self.assertEqual(
+            buffer.result(10),
+            self.tt.track({'events': self.events[:8], 'ttl': 4,
+                           'currentTime': 10}))
+
+    def test_tracker_cache(self):
+        # should match track on polls with growing events and current time
+        cache = kbtt.TrackerCache(size=1)
+        for size, current_time in ((3, 3), (3, 5), (8, 9), (8, 20), (6, 20),
+                                   (14, 30), (14, None), (14, 2)):
+            value = {'events': self.events[:size], 'ttl': 4,
+                     'currentTime': current_time}
+            self.assertEqual(cache.track('session', value),
+                             self.tt.track(value))
+        self.assertEqual(cache.sessions['session'][1], 14)
+
+        # should rebuild sessions on new ttl and events preceding cached ones
+        value = {'events': self.events[:8], 'ttl': 2, 'currentTime': 20}
+        self.assertEqual(cache.track('session', value), self.tt.track(value))
+        value['events'] = value['events'] + self.events[2:3]
+        self.assertEqual(cache.track('session', value), self.tt.track(value))
+        self.assertTrue('error' in cache.track('session', '{}'))
+
+        # should evict least recently used sessions
+        cache.track('other', value)
+        self.assertEqual(list(cache.sessions), ['other'])
+
+    def test_snapshot(self):
+        # should resume from a stored snapshot on every split of the log
+        with SnapshotStore() as store:
+            for i in range(len(self.events)):
+                session = TrackingSession(4)
+                session.extend(self.events[:i])
+                store.save('session', session)
+                session = store.load('session')
+                self.assertEqual(
+                    session.append(self.events[i:], 20),
+                    self.tt.track({'events': self.events, 'ttl': 4,
+                                   'currentTime': 20}))
+
+            store.delete('session')
+            self.assertIsNone(store.load('session'))
+
+        with self.assertRaises(ValueError):
+            TrackingSession.restore({'version': 0})
+
+
+class TableTimeTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.table = kbtt.TableTimeTracker()
+
+    def test_random_logs(self):
+        # should match the default engine on every stage
+        rng = random.Random(0)
+        for _ in range(200):
+            events = random_events(rng)
+            events.sort(key=kbtt.get_time)
+            ttl = rng.choice((0, 1, 2.5, 4))
+            current_time = rng.choice((None, 20, 50))
+            self.assertEqual(self.table.find_device_streams(events),
+                             self.tt.find_device_streams(events))
+            flattened = self.tt.flatten_event_stream(events, ttl,
+                                                     current_time)
+            self.assertEqual(
+                self.table.flatten_event_stream(events, ttl, current_time),
+                flattened)
+
+            # streams starting with a disconnect fail on both
+            try:
+                expected = self.tt.reduce_events(flattened)
+            except KeyError:
+                with self.assertRaises(KeyError):
+                    self.table.reduce_events(flattened)
+            else:
+                self.assertEqual(self.table.reduce_events(flattened),
+                                 expected)
+
+    def test_generated_sessions(self):
+        for jitter in (0.3, 0.6, 0.9):
+            value = bench.generate_events(500, devices=3, jitter=jitter)
+            self.assertEqual(kbtt.TableTimeTracker(1).track(value, True),
+                             TimeTracker(1).track(value, True))
+            self.assertEqual(self.table.track(value, True),
+                             self.tt.track(value, True))
+
+
+class CompactTimeTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.compact = kbtt.CompactTimeTracker()
+
+    def test_decode_events(self):
+        # should intern string ids and decode parsed events in place
+        value, events = self.compact.decode(json.dumps({
+            'events': [
+                {'t': 's', 'c': 0,},
+                {'t': 'c', 'c': 1, 'u': 'user', 'd': 'device',},
+                {'t': 'c', 'c': 2, 'u': 'user', 'd': 'device',},
+            ],
+            'ttl': 4,
+            'currentTime': 10,
+        }))
+        self.assertIs(events, value['events'])
+        self.assertTrue(all(isinstance(i, kbtt.Event) for i in events))
+        self.assertIs(events[1].d, events[2].d)
+        self.assertIs(events[1].u, events[2].u)
+
+        # should sort decoded records in place
+        events.reverse()
+        self.compact.track_events(events, 4, 10)
+        self.assertEqual([i.c for i in events], [0, 1, 2])
+
+    def test_random_logs(self):
+        # should match the default engine on flattened and tracked events
+        rng = random.Random(0)
+        for _ in range(200):
+            events = random_events(rng)
+            ttl = rng.choice((0, 1, 2.5, 4))
+            current_time = rng.choice((None, 20, 50))
+            self.assertEqual(
+                self.compact.flatten_event_stream(
+                    self.compact.decode_events(events), ttl, current_time),
+                self.tt.flatten_event_stream(events, ttl, current_time))
+
+            value = {'events': events, 'ttl': ttl,
+                     'currentTime': current_time}
+            try:
+                expected = self.tt.track(value, intervals=True)
+            except KeyError:
+                continue
+            self.assertEqual(self.compact.track(json.dumps(value), True),
+                             expected)
+
+    def test_generated_sessions(self):
+        value = bench.generate_events(500, devices=3, jitter=0.7)
+        self.assertEqual(self.compact.track(value), self.tt.track(value))
+        self.assertEqual(self.compact.sweep_ttl(value, [10, 30]),
+                         self.tt.sweep_ttl(value, [10, 30]))
+
+
+@unittest.skipIf(importlib.util.find_spec('numpy') is None,
+                 'numpy is not installed')
+class ColumnarTimeTrackerTest(unittest.TestCase):
+    def setUp(self):
+        self.tt = TimeTracker()
+        self.ct = ColumnarTimeTracker()
+
+    def assertSameFlatten(self, events, ttl, current_time):
+        self.assertEqual(
+            self.ct.flatten_event_stream(events, ttl, current_time),
+            self.tt.flatten_event_stream(events, ttl, current_time))
+
+    def test_flatten_event_stream(self):
+        self.assertSameFlatten([], 4, 10)
+        self.assertSameFlatten([
+            {'t': 's', 'c': 0,},
+            {'t': 'p', 'c': 1,},
+            {'t': 'c', 'c': 2, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 3, 'u': 2, 'd': '2',},
+            {'t': 'c', 'c': 6, 'u': 1, 'd': '1',},
+            {'t': 'u', 'c': 7,},
+        ], 4, 10)
+
+        # should keep first event quirks and user of trailing disconnect
+        self.assertSameFlatten([
+            {'t': 'd', 'c': 0, 'u': 1, 'd': '1',},
+            {'t': 'd', 'c': 1, 'u': 1, 'd': '1',},
+            {'t': 'c', 'c': 1, 'u': 2, 'd': 2,},
+            {'t': 'c', 'c': 2, 'u': 3, 'd': 2,},
+        ], 4, 10)
+        self.assertSameFlatten([
+            {'t': 'c', 'c': 1, 'u': 2, 'd': 2,},
+            {'t': 'c', 'c': 2, 'u': 3, 'd': 2,},
+        ], 0, 10)
+
+        # should stop on end event and skip duplicate pause events
+        self.assertSameFlatten([
+            {'t': 'p', 'c': 1,},
+            {'t': 'c', 'c': 1, 'u': 1, 'd': '1',},
+            {'t': 'p', 'c': 2,},
+            {'t': 'u', 'c': 3,},
+            {'t': 'e', 'c': 3,},
+            {'t': 'c', 'c': 3, 'u': 2, 'd': '2',},
+        ], 4, 10)
+
+    def test_random_logs(self):
+        rng = random.Random(0)
+        for _ in range(200):
+            events = random_events(rng)
+            self.assertSameFlatten(events, rng.choice((1, 2.5, 4)),
+                                   rng.choice((None, 20, 50)))
+
+    def test_mixed_times(self):
+        # should keep int times among float ones as ints
+        value = {
+            'events': [
+                {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+                {'t': 's', 'c': 0.5,},
+                {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+                {'t': 'e', 'c': 3,},
+            ],
+            'ttl': 10,
+            'currentTime': 4,
+        }
+        self.assertEqual(json.dumps(self.ct.track(value, intervals=True)),
+                         json.dumps(self.tt.track(value, intervals=True)))
+
+    def test_track_log(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'events.kbtl')
+            value = bench.generate_events(500, devices=3, jitter=0.6)
+            self.tt.convert_log(value, path)
+            with kbtt.EventLog(path) as log:
+                self.assertEqual(self.ct.track_log(log),
+                                 self.tt.track(value))
+
+            # should keep int times of mixed time logs as ints
+            value = {
+                'events': [
+                    {'t': 'c', 'c': 0, 'u': 1, 'd': '1',},
+                    {'t': 's', 'c': 0.5,},
+                    {'t': 'c', 'c': 1, 'u': 2, 'd': '2',},
+                    {'t': 'e', 'c': 3,},
+                ],
+                'ttl': 10,
+                'currentTime': 4,
+            }
+            self.tt.convert_log(value, path)
+            with kbtt.EventLog(path) as log:
+                self.assertEqual(json.dumps(self.ct.track_log(log)),
+                                 json.dumps(self.tt.track_log(log)))
+
+
+class FuzzTest(unittest.TestCase):
+    def test_engines(self):
+        # should match the dict engine on random values
+        with concurrent.futures.ThreadPoolExecutor(2) as executor:
+            stats = fuzz.run(300, engines=fuzz.get_engines(executor))
+        self.assertTrue('parallel' in stats and 'dict' not in stats)
+        for engine_stats in stats.values():
+            self.assertEqual(engine_stats['failures'], 0)
+            self.assertEqual(engine_stats['cases'], 304)
+        # polling engines should reject null and early currentTime values
+        self.assertTrue(stats['session']['rejected'])
+        self.assertTrue(stats['ndjson']['rejected'])
+        self.assertFalse(stats['table']['rejected'])
+
+    def test_rejected(self):
+        def track_accepting(value):
+            return TimeTracker().track(value)
+
+        # should fail polling engines returning results for early times
+        track_accepting.expected_error = fuzz.session_error
+        engines = {'dict': fuzz.track_engine(TimeTracker),
+                   'accepting': track_accepting}
+        stats = fuzz.run(100, engines=engines)
+        self.assertTrue(stats['accepting']['failures'])
+        self.assertEqual(fuzz.session_error(stats['accepting']['failure']),
+                         {'error': 'Current time precedes appended events.'})
+
+    def test_type_strict(self):
+        def track_float(value):
+            events = [dict(event, c=float(event['c']))
+                      for event in value['events']]
+            return TimeTracker().track(dict(value, events=events))
+
+        # should tell float times from int ones
+        value = {'events': [{'t': 'c', 'c': 0, 'u': 1, 'd': '1'},
+                            {'t': 'c', 'c': 0, 'u': 2, 'd': '2'},
+                            {'t': 'e', 'c': 3}],
+                 'ttl': 10, 'currentTime': 4}
+        self.assertEqual(track_float(value), TimeTracker().track(value))
+        self.assertTrue(fuzz.is_failing(
+            track_float, fuzz.track_engine(TimeTracker), value))
+
+    def test_shrink(self):
+        class LateExpiryTimeTracker(TimeTracker):
+            def disconnect_event(self, time, user, device):
+                return super().disconnect_event(time + 1, user, device)
+
+        def track_late(value):
+            result = LateExpiryTimeTracker().sweep_ttl(value, [value['ttl']])
+            del result[0]['ttl']
+            return result[0]
+
+        # should find and shrink failures of a wrong expiry time
+        engines = {'dict': fuzz.track_engine(TimeTracker), 'late': track_late}
+        stats = fuzz.run(200, engines=engines)
+        self.assertTrue(stats['late']['failures'])
+        failure = stats['late']['failure']
+        self.assertTrue(fuzz.is_failing(track_late, engines['dict'], failure))
+        self.assertTrue(1 <= len(failure['events']) <= 3)
+
+
+class GenerateEventsTest(unittest.TestCase):
+    def test_generate_events(self):
+        # should be reproducible with the same seed
+        self.assertEqual(bench.generate_events(100, seed=1),
+                         bench.generate_events(100, seed=1))
+        self.assertNotEqual(bench.generate_events(100, seed=1),
+                            bench.generate_events(100, seed=2))
+
+        # should follow requested size, devices and users
+        value = bench.generate_events(500, devices=5, users=3, ttl=10)
+        self.assertEqual(len(value['events']), 500)
+        self.assertEqual(value['ttl'], 10)
+        self.assertEqual({i['d'] for i in value['events'] if 'd' in i},
+                         {'1', '2', '3', '4', '5'})
+        self.assertEqual({i['u'] for i in value['events'] if 'u' in i},
+                         {1, 2, 3})
+        self.assertEqual(value['events'], sorted(value['events'],
+                                                 key=kbtt.get_time))
+        self.assertFalse('error' in TimeTracker().track(value))
+
+        # should deliver some events late
+        value = bench.generate_events(500, disorder=0.2)
+        self.assertNotEqual(value['events'], sorted(value['events'],
+                                                    key=kbtt.get_time))
+        self.assertFalse('error' in TimeTracker().track(value))
+
 
 if __name__ == "__main__":
     unittest.main()